@@ -0,0 +1,25 @@
+"""Build the token-length index of the test corpus (see utils/token_lengths.py).
+
+    python build_lengths.py --dataset msc --session_id 2-5
+    python build_lengths.py --dataset msc --session_id 5 --hf_tokenizer meta-llama/Llama-2-7b-hf
+
+Counts are stored for tiktoken cl100k_base and, with --hf_tokenizer, for that tokenizer too.
+"""
+from config import get_args
+from dataloader import test_source
+from utils.token_lengths import FIELDS, length_index, tokenizer_key
+
+if __name__ == "__main__":
+    args = get_args()
+    tokenizers = [None]
+    if args.hf_tokenizer:
+        from transformers import AutoTokenizer
+        tokenizers.append(AutoTokenizer.from_pretrained(args.hf_tokenizer))
+    for session_id in args.session_ids:
+        args.session_id = session_id
+        loader, params = test_source(args)
+        samples = loader(args, *params)
+        for tokenizer in tokenizers:
+            lengths = length_index(args, loader, *params, tokenizer=tokenizer, samples=samples)
+            means = ", ".join(f"{field} {lengths[:, i].mean():.1f}" for i, field in enumerate(FIELDS))
+            print(f"session {session_id} {tokenizer_key(tokenizer)}: {len(lengths)} samples, mean tokens {means}")
@@ -2,6 +2,10 @@ import json
 from torch.utils.data import DataLoader, Dataset
 import random
 from functools import partial
+from utils.corpus_cache import corpus_cache
+from utils.jsonl import read_jsonl
+from utils.line_index import line_index
+from utils.parallel_load import load_parallel
 
 speaker_dict = {"Speaker 1": "User", "Speaker 2": "System"}
 carecall_dict = {"user":"User", "system":"System"}
@@ -27,9 +31,10 @@ class MSCDataset(Dataset):
     def __len__(self):
         return len(self.data)
 
-def read_msc_data(args, path_name):
-    with open(path_name, "r") as f:
-        raw_data = [json.loads(line.strip()) for line in f]
+@corpus_cache("chatgpt_msc_data", version=1, sources=lambda args, path_name, limit=None: [path_name])
+def read_msc_data(args, path_name, limit=None):
+    """Read the turns of the first limit dialogues (all if limit is None)."""
+    raw_data = read_jsonl(path_name, limit)
     data = []
 
     for dial in raw_data:
@@ -65,6 +70,8 @@ def read_msc_data(args, path_name):
             curr_list.append(f"{speaker_role}: {speaker_text}")
     return data
 
+@corpus_cache("chatgpt_care_data", version=1, arg_names=("session_id", "random_seed", "n_shot"),
+              sources=lambda args, path_name: [path_name])
 def read_care_data(args, path_name):
     raw_data = json.load(open(path_name))
     data = [[] for i in range(5)]
@@ -113,33 +120,12 @@ def read_care_data(args, path_name):
         example["full"] += f"[Dialogue Context] {full_context} [Response] {response}"
     return select_data, example
 
-def count_data(path_name):
-    with open(path_name, "r") as f:
-        raw_data = [json.loads(line.strip()) for line in f]
-    count = 0
-    token_num = 0
-    for dial in raw_data:
-        history = []
-        prev_dialogs = dial["previous_dialogs"]
-        for prev in prev_dialogs:
-            for idx, item in enumerate(prev["dialog"]):
-                if idx % 2 == 0:
-                    history.append("User: " + item["text"])
-                else:
-                    history.append("System: " + item["text"])
-        for idx, item in enumerate(dial["dialog"]):
-            if item["id"] == "Speaker 2":
-                token_num += len(" ".join(history).split(" "))
-                count += 1
-            speaker_id, speaker_text = item["id"], item["text"]
-            history.append(f"{speaker_id}: {speaker_text}")
-
-    return token_num / count * 1.00
-
-
 def load_example(args, path_name):
-    with open(path_name, "r") as f:
-        raw_data = [json.loads(line.strip()) for line in f]
+    # only the n_shot sampled dialogues are read; sampling positions picks the same dialogues
+    # as sampling the parsed list did
+    index = line_index(args, path_name)
+    random.seed(args.random_seed)
+    raw_data = [index.record(position) for position in random.sample(range(len(index)), args.n_shot)]
 
     summaries = json.load(open("data/msc/msc/msc_dialogue/sessionlevel_summaries_subsample5.json", "r"))
 
@@ -182,8 +168,6 @@ def load_example(args, path_name):
         # print(" ".join(history[-args.window_size*2:]))
         data.append(dial_item)
 
-    random.seed(args.random_seed)
-    data = random.sample(data, args.n_shot)
     example = {"window":"", "full":"", "update_response":"", "update_summary":""}
     for item in data:
         window_context, full_context = item["window"], item["full"]
@@ -196,15 +180,22 @@ def load_example(args, path_name):
         example["full"] += f"[Dialogue Context] {full_context} [Response] {response}"
     return example
 
+def select_test_dialogues(data, test_num):
+    """Keep the turns of the first test_num dialogues."""
+    dial_ids = list(dict.fromkeys(item["dial_id"].split("-")[0] for item in data))
+    keep = set(dial_ids[:test_num])
+    return [item for item in data if item["dial_id"].split("-")[0] in keep]
+
 def prepare_test_data(args):
     if args.dataset == "msc":
         path_test = f'data/msc/msc/msc_dialogue/session_{args.session_id}/test.txt'
-        data_test = read_msc_data(args, path_test)
+        data_test = read_msc_data(args, path_test, args.test_num)
         path_valid = f'data/msc/msc/msc_dialogue/session_2/valid.txt'
         examples = load_example(args, path_valid)
     elif args.dataset == "carecall":
         path_test = f'data/carecall/carecall-memory_en_auto_translated.json'
         data_test, examples = read_care_data(args, path_test)
+        data_test = select_test_dialogues(data_test, args.test_num)
 
     return data_test, examples
 
@@ -231,9 +222,9 @@ def prepare_data(args, tokenizer):
     elif args.dataset == "carecall":
         path_train = f'data/carecall/carecall-memory_en_auto_translated.json'
 
-    data_train = read_msc_data(args, path_train)
-    data_dev = read_msc_data(args, path_dev)
-    data_test = read_msc_data(args, path_test)
+    data_train, data_dev, data_test = load_parallel(args, [(read_msc_data, path_train),
+                                                           (read_msc_data, path_dev),
+                                                           (read_msc_data, path_test)])
 
     train_dataset = MSCDataset(data_train)
     dev_dataset = MSCDataset(data_dev)
@@ -2,14 +2,19 @@ import openai
 import backoff
 import os
 import re, time
+from functools import lru_cache
 from openai import OpenAI
 from utils.env import ensure_openai_api_key
-api_key = ensure_openai_api_key()
-client = OpenAI(api_key=api_key)
+
+@lru_cache(maxsize=None)
+def get_client():
+    """The OpenAI client, created on the first request so that importing this module (e.g. for --dry_run) needs no key."""
+    return OpenAI(api_key=ensure_openai_api_key())
+
 def gpt_summary_results(args, prompt):
     for i in range(100):
         try:
-            completion = client.chat.completions.create(
+            completion = get_client().chat.completions.create(
                 model= args.model_name,
                 messages=[
             {"role": "system",
@@ -32,7 +37,7 @@ def gpt_summary_results(args, prompt):
 def gpt_response_results(args, prompt):
     for i in range(100):
         try:
-            completion = client.chat.completions.create(
+            completion = get_client().chat.completions.create(
             model= args.model_name,
                     messages=[
             {"role": "system",
@@ -49,8 +54,25 @@ def gpt_response_results(args, prompt):
 
     return line_m
 
+def gpt_response_stream(args, prompt):
+    """Same request as gpt_response_results, but yields the response text piece by piece."""
+    stream = get_client().chat.completions.create(
+        model= args.model_name,
+        messages=[
+            {"role": "system",
+             "content": "You are an advanced AI language model designed to engage in personality-based conversations."},
+            {"role": "user",
+             "content": prompt,
+             }],
+        temperature=0,
+        stream=True,
+    )
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
 def davinci_response_results(args, prompt):
-    openai.api_key = api_key
+    openai.api_key = ensure_openai_api_key()
     while True:
         try:
             response = openai.Completion.create(
@@ -67,7 +89,7 @@ def davinci_response_results(args, prompt):
     return message
 
 def davinci_summary_results(args, prompt):
-    openai.api_key = api_key
+    openai.api_key = ensure_openai_api_key()
     while True:
         try:
             response = openai.Completion.create(
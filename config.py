@@ -5,9 +5,10 @@ def get_args():
     parser = argparse.ArgumentParser()
     #dataset param
     parser.add_argument("--dataset", type=str, default="msc", help="msc or carecall")
-    parser.add_argument("--session_id", type=int, default=5, help="1,2,3,4,5")
+    parser.add_argument("--session_id", type=str, default="5", help="1,2,3,4,5 or a range such as 2-5")
     parser.add_argument("--mode", type=str, default="full", help="full, window, rsum, rag, sum")
     parser.add_argument("--nopersona_subsampling_weight", type=float, default=0)
+    parser.add_argument("--shuffle_buffer", type=int, default=10000, help="the number of examples shuffled together when streaming training data")
     parser.add_argument("--max_seq_length", type=int, default=4000)
 
     parser.add_argument("--summary_size", type=int, default=200)
@@ -31,9 +32,22 @@ def get_args():
     parser.add_argument("--train_batch_size", type=int, default=2)
     parser.add_argument("--dev_batch_size", type=int, default=2)
     parser.add_argument("--test_batch_size", type=int, default=4)
+    parser.add_argument("--num_workers", type=int, default=0, help="DataLoader worker processes for local-model generation")
+    parser.add_argument("--persistent_workers", action='store_true', help="keep the DataLoader workers alive between epochs")
+    parser.add_argument("--length_grouping", type=int, default=1, help="1 to batch local-model generation by prompt length, 0 for dataset order")
+    parser.add_argument("--data_cache", type=str, default="data/.cache", help="directory of the parsed-corpus cache, empty to disable")
+    parser.add_argument("--load_workers", type=int, default=0, help="processes for parsing corpus files, 0 for one per CPU")
+    parser.add_argument("--hf_tokenizer", type=str, default="", help="HF tokenizer (path or hub id) whose token counts build_lengths.py also stores")
     parser.add_argument("--test_num", type=int, default=300, help="the number of test dialogue")
     parser.add_argument("--n_shot", type=int, default=1, help="the number of N-shot")
     parser.add_argument("--summary_type", type=str, default="pred", help="pred or gt")
+    parser.add_argument("--memory_type", type=str, default="text", help="text or facts")
+    parser.add_argument("--memory_db", type=str, default="", help="SQLite file for persisting memories, empty to use the pickle/json files")
+    parser.add_argument("--memory_archive", type=str, default="", help="snapshot archive built by utils/snapshot_store.py to read previous memories from")
+    parser.add_argument("--memory_select", type=str, default="none", help="none, bm25 or dense")
+    parser.add_argument("--memory_topk", type=int, default=10, help="the number of memory sentences kept by --memory_select")
+    parser.add_argument("--memory_budget", type=int, default=150, help="the token budget of the selected memory, 0 for no limit")
+    parser.add_argument("--select_model", type=str, default="sentence-transformers/all-MiniLM-L6-v2")
     #
     parser.add_argument("--local-rank", type=int, default=-1)
     parser.add_argument("--summary_model_name", type=str, default="gpt-3.5-turbo-0301", help="Choose model for inference")
@@ -45,14 +59,40 @@ def get_args():
     parser.add_argument("--gradient_accumulation_steps", type=int, default=8)
     parser.add_argument("--n_epoch", type=int, default=3)
 
+    #distill
+    parser.add_argument("--summary_backend", type=str, default="api", help="api or local (a distilled summarizer loaded from --load_path)")
+    parser.add_argument("--distill_log", type=str, default="", help="jsonl file that records every memory update call")
+    parser.add_argument("--distill_file", type=str, default="save_msc/distill_triples.jsonl", help="the harvested (memory, context, updated memory) triples")
+    parser.add_argument("--lora_r", type=int, default=8)
+
     #load
     parser.add_argument("--load_path", type=str, default="")
     parser.add_argument("--topk", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=8, help="the number of dialogues processed in parallel")
+
+    parser.add_argument("--dry_run", action='store_true', help="render every prompt and estimate tokens, cost and time without calling the API")
+    parser.add_argument("--call_latency", type=float, default=1.0, help="expected seconds per API call before generation, for --dry_run")
+    parser.add_argument("--output_tps", type=float, default=50.0, help="expected generated tokens per second, for --dry_run")
+
+    #serve
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--queue_size", type=int, default=8, help="the maximum number of pending turns per user")
+    parser.add_argument("--idle_timeout", type=float, default=1800, help="seconds after which an idle conversation is dropped from memory, 0 to keep every conversation")
 
 
     args = parser.parse_args()
+    args.session_ids = parse_session_ids(args.session_id)
+    args.session_id = args.session_ids[0]
     return args
 
+def parse_session_ids(value):
+    """Parse "5" into [5] and "2-5" into [2, 3, 4, 5]."""
+    if "-" in str(value):
+        start, end = str(value).split("-", 1)
+        return list(range(int(start), int(end) + 1))
+    return [int(value)]
+
 def get_logger(file_log, fh_mode="w"):
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
@@ -0,0 +1,78 @@
+"""Token-length statistics of the test corpora, from the token-length index (utils/token_lengths.py).
+
+    python corpus_stats.py --dataset msc --session_id 2-5
+    python corpus_stats.py --dataset msc --session_id 5 --hf_tokenizer meta-llama/Llama-2-7b-hf
+
+For every session and split it prints the mean, percentiles and a histogram of the full
+context, window, history, memory and response lengths, and the number of turns per dialogue.
+The index is built on the first run and memory-mapped afterwards.
+"""
+import os
+
+import numpy as np
+
+from config import get_args
+from dataloader import read_msc_test_data, read_care_data, test_source
+from utils.token_lengths import FIELDS, length_index, tokenizer_key
+
+PERCENTILES = (50, 90, 95, 99)
+HISTOGRAM_EDGES = (0, 64, 128, 256, 512, 1024, 2048, 4096, np.inf)
+NAMES = {"label": "response"}
+
+
+def split_sources(args):
+    """(split name, loader, params) of every split of the session whose file exists."""
+    if args.dataset == "msc":
+        for split in ("train", "valid", "test"):
+            if os.path.exists(f'data/msc/msc/msc_dialogue/session_{args.session_id}/{split}.txt'):
+                # every turn of the split, not the first MAX_TEST_TURNS the test runs use
+                yield split, read_msc_test_data, (split, None)
+    else:
+        loader, params = test_source(args)
+        if os.path.exists(params[0]):
+            yield "all", loader, params
+
+
+def dialogue_of(dial_id):
+    return dial_id.split("-")[0] if "-" in dial_id else dial_id.rsplit("_", 1)[0]
+
+
+def describe(values):
+    percentiles = np.percentile(values, PERCENTILES)
+    counts, _ = np.histogram(values, bins=HISTOGRAM_EDGES)
+    return {
+        "mean": values.mean(),
+        **{f"p{p}": value for p, value in zip(PERCENTILES, percentiles)},
+        "max": values.max(),
+        "histogram": counts,
+    }
+
+
+def print_stats(title, lengths, samples):
+    print(f"== {title}: {len(samples)} samples")
+    header = "  {:<9}{:>8}".format("field", "mean") + "".join(f"{f'p{p}':>8}" for p in PERCENTILES) + f"{'max':>8}"
+    edges = [f"<{int(edge)}" for edge in HISTOGRAM_EDGES[1:-1]] + [f">={int(HISTOGRAM_EDGES[-2])}"]
+    print(header + "   histogram " + " ".join(edges))
+    columns = [(NAMES.get(field, field), lengths[:, i]) for i, field in enumerate(FIELDS)]
+    _, turns = np.unique(np.asarray([dialogue_of(sample["dial_id"]) for sample in samples]), return_counts=True)
+    columns.append(("turns", turns))
+    for name, values in columns:
+        stats = describe(np.asarray(values, dtype=np.float64))
+        row = "  {:<9}{:>8.1f}".format(name, stats["mean"]) + "".join(f"{stats[f'p{p}']:>8.0f}" for p in PERCENTILES)
+        print(row + f"{stats['max']:>8.0f}   histogram " + " ".join(str(count) for count in stats["histogram"]))
+
+
+if __name__ == "__main__":
+    args = get_args()
+    tokenizer = None
+    if args.hf_tokenizer:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.hf_tokenizer)
+    for session_id in args.session_ids:
+        args.session_id = session_id
+        for split, loader, params in split_sources(args):
+            samples = loader(args, *params)
+            if len(samples) == 0:
+                continue
+            lengths = length_index(args, loader, *params, tokenizer=tokenizer, samples=samples)
+            print_stats(f"{args.dataset} session {session_id} {split} ({tokenizer_key(tokenizer)} tokens)", lengths, samples)
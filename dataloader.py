@@ -3,6 +3,9 @@ from torch.utils.data import DataLoader, Dataset
 import random
 from functools import partial
 from utils.evaluation import compute_f1, compute_f1_sentence
+from utils.persona_merge import merge_personas, summary_windows
+from utils.jsonl import read_jsonl
+from utils.parallel_load import load_parallel
 from torch.utils.data import random_split
 import copy
 import math
@@ -10,7 +13,10 @@ from tqdm import tqdm
 import torch
 import os
 count = 0
-from dataset import RSumDataset, NerCollate, MSCDataset, RAGDataset, SumDataset
+from dataset import RSumDataset, NerCollate, MSCDataset, RAGDataset, SumDataset, StreamingSumDataset
+from utils.corpus_cache import corpus_cache
+from utils.line_index import line_index
+from utils.turns import Dialogue, MSCTurn, CareTurn, ChatTurn
 
 random.seed(42)
 
@@ -37,29 +43,8 @@ PROMPT_TEMPLATE = {
     "dialog_ict": "[INST]<<SYS>>\n{instruction}\n<</SYS>>\n\nYou will be provided with a summary containing personality information for both yourself and the user, as well as a dialogue context. Your goal is to respond to the user based on the dialogue context and summary. If there isn't a specific relevant personality trait revelant to user's query, you should still respond naturally and conversationally. \nI will show you an example as the demonstration: {demo_string}\n\nThe following is a dialogue you need to test: {input}\nResponse to the user within 30 words: [/INST]",
 }
 IGNORE_INDEX=-100
-
-def count_data(path_name):
-    with open(path_name, "r") as f:
-        raw_data = [json.loads(line.strip()) for line in f]
-    count = 0
-    token_num = 0
-    for dial in raw_data:
-        history = []
-        prev_dialogs = dial["previous_dialogs"]
-        for prev in prev_dialogs:
-            for idx, item in enumerate(prev["dialog"]):
-                if idx % 2 == 0:
-                    history.append("User: " + item["text"])
-                else:
-                    history.append("System: " + item["text"])
-        for idx, item in enumerate(dial["dialog"]):
-            if item["id"] == "Speaker 2":
-                token_num += len(" ".join(history).split(" "))
-                count += 1
-            speaker_id, speaker_text = item["id"], item["text"]
-            history.append(f"{speaker_id}: {speaker_text}")
-
-    return token_num / count * 1.00
+# by default read_msc_test_data keeps the first MAX_TEST_TURNS assistant turns of the split
+MAX_TEST_TURNS = 1000
 
 def collate_fn(batch):
     inputs = [item["input"] for item in batch]
@@ -67,12 +52,16 @@ def collate_fn(batch):
     dial_ids = [item["dial_id"] for item in batch]
     return {"input": inputs, "label": labels, "dial_ids":dial_ids}
 
-def load_dataset(args):
+def test_source(args):
+    """The cached loader of the test corpus and its parameters."""
     if args.dataset == "msc":
-        test_data = read_msc_test_data(args, "test")
+        return read_msc_test_data, ("test", MAX_TEST_TURNS, args.test_num)
     elif args.dataset == "carecall":
-        test_path = f'data/carecall/carecall-memory_en_auto_translated.json'
-        test_data = read_care_data(args, test_path)
+        return read_care_data, ('data/carecall/carecall-memory_en_auto_translated.json',)
+
+def load_dataset(args):
+    loader, params = test_source(args)
+    test_data = loader(args, *params)
     
     if args.mode == "rsum":
         test_dataset = RSumDataset(test_data, args)
@@ -86,44 +75,45 @@ def load_dataset(args):
     return test_data, test_dataset
 
 
+@corpus_cache("care_data", version=2, arg_names=("session_id", "mode", "retrieval"),
+              sources=lambda args, path_name: [path_name, "data/carecall/dpr_topk_3.json"])
 def read_care_data(args, path_name):
     raw_data = json.load(open(path_name))
     data = [[] for i in range(5)]
     ave_num = [0 for i in range(5)]
     resp_num = [0 for i in range(5)]
     for session in raw_data:
-        prev_list = []
-        all_content = []
+        dialogue = Dialogue()
         guid_id = session[0]["guid"].split("-")[1]
+        # word counts of the finished sessions and of the current one, for the length statistics
+        prev_words, curr_words = 0, 0
         for sidx, dial in enumerate(session):
-            curr_list = []
+            dialogue.start_session()
+            curr_words = 0
             for tidx, turn in enumerate(dial["dialogue"]):
                 if turn["role"] == "system":
                     if tidx not in [0, 2]:
                         prev_summary = ""
                         if dial["memory"] != []:
                             prev_summary = "; ".join(dial["memory"]).replace("He/She","The user")
-                        dial_item = {
-                            "prev_list": prev_list.copy(),
-                            'history': prev_list.copy(),
-                            "dial_id": guid_id+"_"+str(tidx),
-                            'first_turn': tidx == 4,
-                            "response": turn["text"],
-                            "last_turn": tidx == len(dial["dialogue"]) - 1,
-                            "full": " ".join(prev_list.copy()) + " " + " ".join(curr_list),
-                            "all_content": all_content.copy(),
-                            "window": " ".join(curr_list),
-                            "gt_prev_summary_string": prev_summary,
-                            "summary": "; ".join(dial["summary"]).replace("He/She","The user")
-                        }
+                        dial_item = CareTurn(
+                            dialogue,
+                            dial_id=guid_id+"_"+str(tidx),
+                            first_turn=tidx == 4,
+                            response=turn["text"],
+                            last_turn=tidx == len(dial["dialogue"]) - 1,
+                            gt_prev_summary_string=prev_summary,
+                            summary="; ".join(dial["summary"]).replace("He/She","The user"),
+                        )
                         data[sidx].append(dial_item)
 
-                        ave_num[sidx] = max(ave_num[sidx], len(dial_item['full'].split(" ")))
+                        ave_num[sidx] = max(ave_num[sidx], max(prev_words, 1) + max(curr_words, 1))
                 text = carecall_dict[turn["role"]] + ": " + turn["text"]
-                curr_list.append(text)
-                all_content.append(text)
+                dialogue.add(text)
+                curr_words += len(text.split(" "))
 
-            prev_list.append(" ".join(curr_list))
+            dialogue.end_session()
+            prev_words += curr_words
 
     '''random.seed(args.random_seed)
     select_data = random.sample(data[args.session_id-1], args.test_num)
@@ -153,7 +143,8 @@ def read_care_data(args, path_name):
 def read_rag_data(args, dataset, path_name):
     with open(path_name, "r") as f:
         rag_data = json.load(f)
-    for idx, dialog in enumerate(rag_data):
+    # the dataset may stop early (MAX_TEST_TURNS), the retrieval file covers the whole split
+    for idx, dialog in enumerate(rag_data[:len(dataset)]):
         full_context = dialog["full"]
         sentences = []
         topk_index = dialog["rag_result_index"]
@@ -168,44 +159,44 @@ def read_rag_data(args, dataset, path_name):
     return dataset
 
 
+@corpus_cache("msc_data", version=2, arg_names=("do_rag", "topk"), sources=lambda args, path_name: [path_name])
 def read_msc_data(args, path_name):
-    with open(path_name, "r") as f:
-        raw_data = [json.loads(line.strip()) for line in f]
+    raw_data = read_jsonl(path_name)
     data = []
 
     #raw_data = random.sample(raw_data, 20)
     for dial in raw_data:
-        prev_content = []
+        dialogue = Dialogue()
         prev_dialogs = dial["previous_dialogs"]
         for prev in prev_dialogs:
             for idx, item in enumerate(prev["dialog"]):
                 if idx % 2 == 0:
-                    prev_content.append({"role":"user","content":item["text"]})
+                    dialogue.add(("user", item["text"]))
                 else:
-                    prev_content.append({"role":"assistant","content":item["text"]})
+                    dialogue.add(("assistant", item["text"]))
                     
-            if prev_content[-1]["role"] == "user":
-                prev_content.pop()
+            if dialogue.utterances[-1][0] == "user":
+                dialogue.utterances.pop()
 
-        win_content = []
+        dialogue.start_session()
         for idx, item in enumerate(dial["dialog"]):
             speaker_text = item["text"]
             if idx % 2 == 0:
                 speaker_role = "user"
             else:
                 speaker_role = "assistant"
-                dial_item = {
-                        "full": copy.deepcopy(prev_content + win_content),
-                        "window": copy.deepcopy(win_content),
-                        "dial_id": item["convai2_id"] + "-" + str(idx),
-                        "label": item["text"],
-                    }
+                dial_item = ChatTurn(
+                        dialogue,
+                        dial_id=item["convai2_id"] + "-" + str(idx),
+                        label=item["text"],
+                    )
                 data.append(dial_item)
 
-            win_content.append({"role": speaker_role, "content":speaker_text})
+            dialogue.add((speaker_role, speaker_text))
 
     print("#Total sample:", len(data))
     if args.do_rag:
+        from utils.rag import rag
         data = rag(data, args.topk)
     
     return data
@@ -217,9 +208,9 @@ def prepare_data(args, tokenizer):
         path_dev = f'data/msc/msc/msc_dialogue/session_{args.session_id}/valid.txt'
         path_test = f'data/msc/msc/msc_dialogue/session_{args.session_id}/test.txt'
 
-        data_train = read_msc_data(args, path_train)
-        data_dev = read_msc_data(args, path_dev)
-        data_test = read_msc_data(args, path_test)
+        data_train, data_dev, data_test = load_parallel(args, [(read_msc_data, path_train),
+                                                               (read_msc_data, path_dev),
+                                                               (read_msc_data, path_test)])
 
     elif args.dataset == "carecall":
         path_train = f'data/carecall/carecall-memory_en_auto_translated.json'
@@ -244,13 +235,12 @@ def prepare_sum_data(args):
     path_dev = f'data/msc/msc/msc_personasummary/session_{args.session_id}/valid.txt'
     path_test = f'data/msc/msc/msc_personasummary/session_{args.session_id}/test.txt'
 
-    data_train = read_sum_data(args, path_train, "train")
-    data_dev = read_sum_data(args, path_dev, "dev")
-    data_test = read_sum_data(args, path_test, "test")
-
-    train_dataset = SumDataset(data_train)
-    dev_dataset = SumDataset(data_dev, split='dev')
-    test_dataset = SumDataset(data_test, split='test')
+    # the episodes are streamed rather than loaded, see StreamingSumDataset; the line indexes are
+    # built (or loaded) here once and pickled into the DataLoader workers, which only seek and read
+    episode_actions = partial(sum_episode_actions, args)
+    train_dataset = StreamingSumDataset(line_index(args, path_train), episode_actions, args)
+    dev_dataset = StreamingSumDataset(line_index(args, path_dev), episode_actions, args, train=False)
+    test_dataset = StreamingSumDataset(line_index(args, path_test), episode_actions, args, train=False)
 
     return train_dataset, dev_dataset, test_dataset
 
@@ -295,28 +285,17 @@ def prepare_rsum_data(args):
                              shuffle=False, collate_fn=partial(sum_collate_fn, args=args, demo=data_demo), num_workers=0)
     return test_loader
 
-def read_msc_test_data(args, dtype):
-    def merge_personas(init_personas, add_personas):
-        
-        if add_personas[0] == [] and add_personas[1] == []:
-            return init_personas
-
-        new_personas = [] 
-        for i in range(2):
-            personas_i = init_personas[i].copy()
-            for ip in add_personas[i]:
-                found = False
-                for j, op in enumerate(personas_i):
-                    if compute_f1_sentence(ip, op) > 0.4:
-                        personas_i[j] = ' '.join([op, ip])
-                        found = True
-                        break
-                if not found:
-                    personas_i.append(ip)
-
-            new_personas.append(personas_i.copy())
-        return new_personas
-    
+@corpus_cache("msc_test_data", version=2, arg_names=("session_id", "mode", "retrieval"),
+              sources=lambda args, dtype, *limits: [f'data/msc/msc/msc_dialogue/session_{args.session_id}/{dtype}.txt',
+                                                    "save_msc/gpt-3.5-old/infer_sum_sid5.json",
+                                                    f"data/msc/msc/msc_dialogue/session_{args.session_id}/dpr_topk_3.json"])
+def read_msc_test_data(args, dtype, limit=MAX_TEST_TURNS, num_dialogues=None):
+    """The assistant turns of a split (the dialogues in sum mode).
+
+    Outside sum mode reading stops after limit turns or the turns of the first num_dialogues
+    dialogues (--test_num), whichever comes first; None means no limit.
+    """
+
     def load_summary_file(args):
         file_path = os.path.join("save_msc/gpt-3.5-old", f"infer_sum_sid5.json")
         if not os.path.exists(file_path): 
@@ -333,8 +312,7 @@ def read_msc_test_data(args, dtype):
         return dict_persona
     
     path_name = f'data/msc/msc/msc_dialogue/session_{args.session_id}/{dtype}.txt'
-    with open(path_name, "r") as f:
-        raw_data = [json.loads(line.strip()) for line in f]
+    raw_data = read_jsonl(path_name)
 
     data = []
     persona_list = {}
@@ -342,6 +320,9 @@ def read_msc_test_data(args, dtype):
     prev_summary_set = load_summary_file(args)
 
     for dialog_dict in tqdm(raw_data):
+        if args.mode != 'sum' and ((limit is not None and len(data) >= limit) or
+                                   (num_dialogues is not None and len(sum_data) >= num_dialogues)):
+            break
         dial_id = dialog_dict["metadata"]["initial_data_id"] 
         pred_prev_summary = [""]
         if prev_summary_set is not None and dial_id in prev_summary_set.keys():
@@ -356,49 +337,39 @@ def read_msc_test_data(args, dtype):
         gt_prev_summary = init_dialog['personas']
         if len(dialog_dict['previous_dialogs']) > 1:
             for prev_dialog in dialog_dict['previous_dialogs'][1:]:
-                gt_prev_summary = merge_personas(gt_prev_summary, prev_dialog['personas'])
+                gt_prev_summary = merge_personas(gt_prev_summary, prev_dialog['personas'], 0.4)
 
-        history = []
-        prev_content_list = []
-        all_content = []
+        dialogue = Dialogue()
         for prev_dialog in prev_dialogs:
-            prev_content = []
+            dialogue.start_session()
             for idx, item in enumerate(prev_dialog["dialog"]):
                 prefix = "User" if idx % 2 == 0 else "Assistant"
-                prev_content.append(f'{prefix}: {item["text"]}')
-                prev_content_list.append(f'{prefix}: {item["text"]}')
-                all_content.append(f'{prefix}: {item["text"]}')
-            history.append(" ".join(prev_content))
-
-        win_content = []      
+                dialogue.add(f'{prefix}: {item["text"]}')
+            dialogue.end_session()
 
         sum_action = {
-            "history": history,
+            "history": dialogue.sessions,
             'pred_prev_summary': [],
             'dial_id': dial_id,
             'gt_prev_summary': gt_prev_summary,
         }      
         sum_data.append(sum_action)
+        gt_prev_summary_string = get_person_string(gt_prev_summary)
+        dialogue.start_session()
         for tidx, turn in enumerate(dialog_dict["dialog"]):
             prefix = "User" if tidx % 2 == 0 else "Assistant"
             if prefix == "Assistant":
-                action = {
-                    "full": " ".join(history + win_content),
-                    "prev_content": prev_content_list.copy(),
-                    'win_content': win_content.copy(),
-                    'all_content': all_content.copy(),
-                    "history": history, 
-                    "window": " ".join(win_content),
-                    'response': turn["text"],
-                    'pred_prev_summary': pred_prev_summary,
-                    'gt_prev_summary': gt_prev_summary,
-                    'gt_prev_summary_string': get_person_string(gt_prev_summary),
-                    'dial_id': dial_id + "-" + str(tidx),
-                }
+                action = MSCTurn(
+                    dialogue,
+                    response=turn["text"],
+                    pred_prev_summary=pred_prev_summary,
+                    gt_prev_summary=gt_prev_summary,
+                    gt_prev_summary_string=gt_prev_summary_string,
+                    dial_id=dial_id + "-" + str(tidx),
+                )
                 data.append(action)
                 
-            win_content.append(f'{prefix}: {turn["text"]}')
-            all_content.append(f'{prefix}: {turn["text"]}')
+            dialogue.add(f'{prefix}: {turn["text"]}')
 
     if args.mode in ['rag', 'rag_mem']:
         rag_file = f"data/msc/msc/msc_dialogue/session_{args.session_id}/dpr_topk_3.json"
@@ -407,7 +378,7 @@ def read_msc_test_data(args, dtype):
     if args.mode == 'sum':
         return sum_data
     else:
-        return data[:1000]
+        return data[:limit]
 
 def create_excel(data):
     import openpyxl
@@ -474,25 +445,6 @@ def prepare_test_sum_data(args):
     return test_loader
 
 def read_sum_test_data(args, dtype):
-    def merge_personas(init_personas, add_personas):
-        if add_personas[0] == [] and add_personas[1] == []:
-            return init_personas
-
-        new_personas = [] 
-        for i in range(2):
-            personas_i = init_personas[i].copy()
-            for ip in add_personas[i]:
-                found = False
-                for j, op in enumerate(personas_i):
-                    if compute_f1_sentence(ip, op) > 0.4:
-                        personas_i[j] = ' '.join([op, ip])
-                        found = True
-                        break
-                if not found:
-                    personas_i.append(ip)
-
-            new_personas.append(personas_i.copy())
-        return new_personas
     
     def load_summary_file(args):
         file_path = os.path.join(args.saving_dir, f"{args.dataset}_summarize_sid{args.session_id-1}.json")
@@ -509,8 +461,7 @@ def read_sum_test_data(args, dtype):
         return str(dict_persona)
 
     path_name = f'data/msc/msc/msc_dialogue/session_{args.session_id}/{dtype}.txt'
-    with open(path_name, "r") as f:
-        raw_data = [json.loads(line.strip()) for line in f]
+    raw_data = read_jsonl(path_name)
 
     data = []
     prev_summary_set = load_summary_file(args)
@@ -530,7 +481,7 @@ def read_sum_test_data(args, dtype):
         personas = init_dialog['personas']
         if len(dialog_dict['previous_dialogs']) > 1:
             for prev_dialog in dialog_dict['previous_dialogs'][1:]:
-                personas = merge_personas(personas, prev_dialog['personas'])
+                personas = merge_personas(personas, prev_dialog['personas'], 0.4)
 
         dial_id = dialog_dict["metadata"]["initial_data_id"]
         prev_summary = {"user persona":"", "assistant persona":""}
@@ -548,32 +499,8 @@ def read_sum_test_data(args, dtype):
         
     return data
 
-def read_sum_data(args, path_name, data_type):
-    def merge_personas(init_personas, add_personas):
-        new_personas = [] 
-        if add_personas[0] == [] and add_personas[1] == []:
-            return init_personas
-
-        for i in range(2):
-            personas_i = init_personas[i].copy()
-            for ip in add_personas[i]:
-                found = False
-                for j, op in enumerate(personas_i):
-                    if compute_f1_sentence(ip, op) > 0.5:
-                        personas_i[j] = ' '.join([op, ip])
-                        found = True
-                        break
-                if not found:
-                    personas_i.append(ip)
-
-            new_personas.append(personas_i.copy())
-        return new_personas
-    
-    def get_person_string(personas_list):
-        user_persona = ' '.join(personas_list[0])
-        assistant_persona = ' '.join(personas_list[1])
-        dict_persona = {"user persona":user_persona, "assistant persona":assistant_persona}
-        return str(dict_persona)
+def sum_episode_actions(args, dialog_dict):
+    """Yield (action, is_negative) for every summary window of one persona-summary episode."""
 
     def get_person_string(personas_list):
         user_persona = " ".join(personas_list[0])
@@ -581,54 +508,39 @@ def read_sum_data(args, path_name, data_type):
         dict_persona = {"user persona":user_persona, "assistant persona":assistant_persona}
         return str(dict_persona)
 
-    with open(path_name, "r") as f:
-        raw_data = [json.loads(line.strip()) for line in f]
+    current_episode = dialog_dict['dialog']
+    init_personachat = dialog_dict['init_personachat']
+    init_personas = init_personachat['init_personas']
+    init_persona_string = get_person_string(init_personas)
+    for end_idx, dialog_texts, end_personas in summary_windows(current_episode, init_personas,
+                                                               args.summary_num_turns, 0.5):
+        end_line_persona = (
+            current_episode[end_idx]['persona_text']
+            if 'persona_text' in current_episode[end_idx]
+            else NOPERSONA
+            )
+        end_persona_string = get_person_string(end_personas)
+
+        action = {
+            'context': ' '.join(dialog_texts),
+            'labels': end_persona_string,
+            'initial_data_id': dialog_dict['initial_data_id'],
+            'init_personas': init_persona_string,
+            'utt_idx': end_idx,
+            'speaker_idx': end_idx % 2,
+            'session_id': args.session_id,
+        }
+        yield action, end_line_persona == NOPERSONA
+
+def read_sum_data(args, path_name, data_type):
+    raw_data = read_jsonl(path_name)
 
     data = []
     negative_data = []
     #raw_data = random.sample(raw_data, 20)
     for dialog_dict in tqdm(raw_data):
-        current_episode = dialog_dict['dialog']
-        init_personachat = dialog_dict['init_personachat']
-        init_personas = init_personachat['init_personas']
-        init_persona_string = get_person_string(init_personas)
-        for end_idx in range(len(current_episode)):
-            if args.summary_num_turns > 0:
-                start_index = max(0, end_idx - args.summary_num_turns + 1)
-            else:
-                start_index = 0
-
-            add_personas = [[],[]]
-            end_line_persona = (
-                current_episode[end_idx]['persona_text']
-                if 'persona_text' in current_episode[end_idx]
-                else NOPERSONA
-                )
-            
-            idx1, idx2 = end_idx, end_idx - 1
-            r1, r2 = idx1 % 2 , idx2 % 2 
-            add_personas[r1] = current_episode[idx1]['agg_persona_list']
-            if idx2 >= 0 :
-                add_personas[r2] = current_episode[idx2]['agg_persona_list']
-
-            end_personas = merge_personas(init_personas, add_personas)
-            end_persona_string = get_person_string(end_personas)
-
-            dialog_texts = []
-            for i in range(start_index, end_idx + 1):
-                prefix = "partner: " if i % 2 == 0 else "you: "
-                dialog_texts.append(f'{prefix}{current_episode[i]["text"]}')
-
-            action = {
-                'context': ' '.join(dialog_texts),
-                'labels': end_persona_string,
-                'initial_data_id': dialog_dict['initial_data_id'],
-                'init_personas': init_persona_string,
-                'utt_idx': end_idx,
-                'speaker_idx': end_idx % 2,
-                'session_id': args.session_id,
-            }
-            if end_line_persona == NOPERSONA:
+        for action, is_negative in sum_episode_actions(args, dialog_dict):
+            if is_negative:
                 negative_data.append(action)
             else:
                 data.append(action)
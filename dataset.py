@@ -1,13 +1,18 @@
-from torch.utils.data.dataset import Dataset
+from torch.utils.data.dataset import Dataset, IterableDataset
 import numpy as np
 import torch
 import json
 import random
+from abc import ABCMeta, abstractmethod
+from collections import ChainMap
 from transformers import DataCollatorWithPadding, BatchEncoding
 from transformers.tokenization_utils import PreTrainedTokenizer
 from typing import Dict, Optional, Sequence, Union, List
 import copy
-predefined_prompts = json.load(open("prompt.json"))
+from utils.memory_select import select_memory
+from utils.prompts import get_prompt, get_template, compile_template
+from utils.token_lengths import FIELDS
+from utils.text_store import build_store
 
 PROMPT_TEMPLATE = (
     "{instruction} Assistant: "
@@ -16,84 +21,206 @@ PROMPT_TEMPLATE = (
 
 IGNORE_INDEX = -100
 
-class RSumDataset(Dataset):
+
+class PromptDataset(Dataset, metaclass=ABCMeta):
+    """Items overlay the rendered "input"/"label" on the samples.
+
+    The fields are rendered once per sample and kept on the dataset. An item is a ChainMap of
+    a copy of them over the sample, so the context views of a turn record are only built when
+    read, and keys set on the item stay on the item: neither the samples (shared with the
+    loader and forked workers) nor the rendered cache are written to.
+    """
+    # the sample fields whose length sets the length of the rendered input
+    length_fields = ("full",)
+
     def __init__(self, data, args):
-        """Reads source and target sequences from txt files."""
         self.data = data
         self.args = args
-        self.prompts = json.load(open("data/msc/msc/msc_dialogue/prompts.json", "r"))
-        self.prompt = "You are an advanced AI designed for engaging in natural, personality-based conversations. You will be provided with a memory, containing the personal preferences and experiences of speakers (the assistant and the user), as well as a dialogue context. When responding, consider maintaining a conversational and fluent tone. Responses should be contextually relevant, consistent with given memory, aiming to keep the conversation flowing. Human queries are labeled 'User:', while your replies are marked 'Assistant:'. Your goal is to provide engaging and coherent responses based on the dialogue context provided. The response is in the form of text and cannot contain emoticons or special characters.The following is the case you need to test:\n The test memory is:{prev_memory}\nThe test dialogue context is:{dialog}\nSo the response to the user is: Assistant:"
-        self.example_prompt = self.prompts["gpt-3.5-turbo"]["example1"]
+        self.rendered = {}
+
+    @abstractmethod
+    def render(self, item_info):
+        """The fields rendered from one sample, e.g. {"input": ..., "label": ...}."""
+
     def __getitem__(self, index):
         """Returns one data pair (source and target)."""
         item_info = self.data[index]
-        if self.args.operation == 'infer':
-            item_info["input"] = self.prompts['gpt-3.5-turbo']['gen_response_with_memory'].format_map(
-                {"prev_memory": item_info["pred_prev_summary"], "dialog": item_info['window']})
-        elif self.args.operation == 'ict':
-            item_info["input"] = self.prompts['gpt-3.5-turbo']['gen_response_with_memory_example'].format_map(
-                {"prev_memory": item_info["pred_prev_summary"], "dialog": item_info['window'], 'example': self.prompts['gpt-3.5-turbo']["example2"]})
-        item_info["label"] = item_info["response"]
-        return item_info
-    
+        rendered = self.rendered.get(index)
+        if rendered is None:
+            rendered = self.rendered[index] = self.render(item_info)
+        return ChainMap(dict(rendered), item_info)
+
     def __len__(self):
         return len(self.data)
-    
-class SumDataset(Dataset):
+
+    def input_lengths(self, lengths):
+        """Approximate input lengths from a token-length index (utils/token_lengths.py)."""
+        return np.asarray(lengths)[:, [FIELDS.index(field) for field in self.length_fields]].sum(axis=1)
+
+
+class RSumDataset(PromptDataset):
+    length_fields = ("window", "pred_memory")
+
     def __init__(self, data, args):
         """Reads source and target sequences from txt files."""
-        self.data = data
-        self.args = args
-        self.prompts = json.load(open("data/msc/msc/msc_dialogue/prompts.json", "r"))
+        super().__init__(data, args)
         self.prompt = "You are an advanced AI designed for engaging in natural, personality-based conversations. You will be provided with a memory, containing the personal preferences and experiences of speakers (the assistant and the user), as well as a dialogue context. When responding, consider maintaining a conversational and fluent tone. Responses should be contextually relevant, consistent with given memory, aiming to keep the conversation flowing. Human queries are labeled 'User:', while your replies are marked 'Assistant:'. Your goal is to provide engaging and coherent responses based on the dialogue context provided. The response is in the form of text and cannot contain emoticons or special characters.The following is the case you need to test:\n The test memory is:{prev_memory}\nThe test dialogue context is:{dialog}\nSo the response to the user is: Assistant:"
-        self.example_prompt = predefined_prompts["gpt-3.5-turbo"]["example"]
-    def __getitem__(self, index):
-        """Returns one data pair (source and target)."""
-        item_info = self.data[index]
-        item_info["input"] = item_info["history"]
-        item_info["label"] = item_info["gt_prev_summary"]
-        return item_info
-    
-    def __len__(self):
-        return len(self.data)
+        self.example_prompt = get_prompt("msc", "gpt-3.5-turbo", "example1")
+
+    def render(self, item_info):
+        rendered = {"label": item_info["response"]}
+        window = item_info['window']
+        prev_memory = select_memory(self.args, item_info["pred_prev_summary"], window)
+        if self.args.operation == 'infer':
+            rendered["input"] = get_template("msc", "gpt-3.5-turbo", "gen_response_with_memory").format_map(
+                {"prev_memory": prev_memory, "dialog": window})
+        elif self.args.operation == 'ict':
+            rendered["input"] = get_template("msc", "gpt-3.5-turbo", "gen_response_with_memory_example").format_map(
+                {"prev_memory": prev_memory, "dialog": window, 'example': get_prompt("msc", "gpt-3.5-turbo", "example2")})
+        return rendered
 
 
-class RAGDataset(Dataset):
+class SumDataset(PromptDataset):
+    length_fields = ("history",)
     def __init__(self, data, args):
         """Reads source and target sequences from txt files."""
-        self.data = data
-        self.args = args
+        super().__init__(data, args)
+        self.prompt = "You are an advanced AI designed for engaging in natural, personality-based conversations. You will be provided with a memory, containing the personal preferences and experiences of speakers (the assistant and the user), as well as a dialogue context. When responding, consider maintaining a conversational and fluent tone. Responses should be contextually relevant, consistent with given memory, aiming to keep the conversation flowing. Human queries are labeled 'User:', while your replies are marked 'Assistant:'. Your goal is to provide engaging and coherent responses based on the dialogue context provided. The response is in the form of text and cannot contain emoticons or special characters.The following is the case you need to test:\n The test memory is:{prev_memory}\nThe test dialogue context is:{dialog}\nSo the response to the user is: Assistant:"
+
+    def render(self, item_info):
+        return {"input": item_info["history"], "label": item_info["gt_prev_summary"]}
+
+
+class RAGDataset(PromptDataset):
+    length_fields = ("window",)
+    def __init__(self, data, args):
+        """Reads source and target sequences from txt files."""
+        super().__init__(data, args)
         self.prompt = "You are an advanced AI designed for engaging in natural, personality-based conversations. You possess the ability to remember past interactions, and personal preferences. You will be provided with dialogue context, as well as the relevant historical context. When responding, consider maintaining a conversational and fluent tone. Responses should be contextually relevant and aim to keep the conversation flowing. Human queries are labeled 'User:', while your replies are marked 'Assistant:'. Your goal is to provide engaging and coherent responses based on the dialogue context provided. The response is in the form of text and cannot contain emoticons or special characters. The following is the history context:{retrieved}\nThe following is the dialogue context: {dialog}\nHere is your response: Assistant:"
 
-    def __getitem__(self, index):
-        """Returns one data pair (source and target)."""
-        item_info = self.data[index]
-        item_info["input"] = item_info["window"]
-        item_info["label"] = item_info["response"]
-        return item_info
+    def render(self, item_info):
+        return {"input": item_info["window"], "label": item_info["response"]}
 
-    def __len__(self):
-        return len(self.data)
-    
-class MSCDataset(Dataset):
+
+class MSCDataset(PromptDataset):
     def __init__(self, data, args):
         """Reads source and target sequences from txt files."""
-        self.data = data
-        self.args = args
+        super().__init__(data, args)
         if self.args.dataset == 'msc':
             #self.prompt = "You are an advanced AI designed for engaging in natural, personality-based conversations. You possess the ability to remember past interactions, and personal preferences. When responding, consider maintaining a conversational and fluent tone. Responses should be contextually relevant and aim to keep the conversation flowing. Human queries are labeled 'User:', while your replies are marked 'Assistant:'. Your goal is to provide engaging and coherent responses based on the dialogue context provided. The response is in the form of text and cannot contain emoticons or special characters. The following is the dialogue context:\n{dialog}\nHere is your response: Assistant:"
             self.prompt = "You are an advanced AI designed for engaging in natural, personality-based conversations. Your goal is to provide engaging and coherent responses based on the dialogue context provided. The response is in the form of text and cannot contain emoticons or special characters. The following is the dialogue context: {dialog}\nSo the response to the user is: Assistant:"
         elif self.args.dataset == 'carecall':
             self.prompt = "Now, you will play the role of the personal health assistant responsible for monitoring the health status of the user. You possess memory, emotions, and preferences. You should: (1) provide warm companionship to the chatting user; (2) understand past dialogue context and extract information from them to answer questions if they are relevant to the current issue; (3) be an excellent healthy assistant, offering warm and helpful suggestions when users confide their difficulties and seek help. The following is a multi-round conversation between you (the assistant) and the user. Human questions are prefixed with 'User:', while your answers are prefixed with 'Assistant:'. You should refer to the dialogue context, and answer user questions naturally and conversationally. The response is in the form of text and cannot contain emoticons or special characters. The following is the dialogue context:\n{dialog}\nHere is your response: Assistant:"
+        self.template = compile_template(self.prompt)
+
+    @property
+    def length_fields(self):
+        return (self.args.mode,)
+
+    def render(self, item_info):
+        return {"input": self.template.format_map({'dialog': item_info[self.args.mode]}), "label": item_info["response"]}
+
+
+class StreamingSumDataset(IterableDataset):
+    def __init__(self, index, episode_actions, args, train=True):
+        """Persona-summary examples streamed from a JSONL file at constant memory.
+
+        index is the LineIndex of the file (utils/line_index.py) and episode_actions(dialog_dict)
+        yields (action, is_negative) for one episode. Every distributed rank and DataLoader worker
+        seeks to its own contiguous share of the episodes with the index. In training, negatives
+        are kept with probability --nopersona_subsampling_weight and examples are shuffled through
+        a buffer of --shuffle_buffer examples; evaluation streams keep everything in file order.
+
+        Every pass draws a new shuffle: the epoch advances at the end of each pass of the copy
+        that iterates (the main process or a persistent worker), and non-persistent workers, which
+        get a fresh copy every epoch, also seed with the per-epoch DataLoader worker seed.
+        set_epoch still pins the epoch, as with a DistributedSampler.
+        """
+        self.index = index
+        self.episode_actions = episode_actions
+        self.args = args
+        self.train = train
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def shard(self):
+        rank, world_size = 0, 1
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        return rank * num_workers + worker_id, world_size * num_workers
+
+    def actions(self, shard, rng):
+        weight = self.args.nopersona_subsampling_weight
+        for dialog_dict in self.index.read_shard(*shard):
+            for action, is_negative in self.episode_actions(dialog_dict):
+                if is_negative and self.train and rng.random() >= weight:
+                    continue
+                yield action
+
+    def __iter__(self):
+        shard = self.shard()
+        worker_info = torch.utils.data.get_worker_info()
+        worker_seed = worker_info.seed if worker_info is not None else 0
+        rng = random.Random(f"{self.args.random_seed}-{self.epoch}-{shard[0]}-{worker_seed}")
+        self.epoch += 1
+        buffer_size = self.args.shuffle_buffer if self.train else 0
+        if buffer_size <= 1:
+            yield from self.actions(shard, rng)
+            return
+        buffer = []
+        for action in self.actions(shard, rng):
+            if len(buffer) < buffer_size:
+                buffer.append(action)
+                continue
+            index = rng.randrange(buffer_size)
+            yield buffer[index]
+            buffer[index] = action
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+class PackedDataset(Dataset):
+    def __init__(self, dataset, fields=("input", "label", "dial_id")):
+        """The given fields of every item of dataset, packed into a shared TextStore (utils/text_store.py)."""
+        self.store = build_store([dataset[index] for index in range(len(dataset))], fields)
+
     def __getitem__(self, index):
-        """Returns one data pair (source and target)."""
-        item_info = self.data[index]
-        item_info["input"] = self.prompt.format_map({'dialog': item_info[self.args.mode]})
-        item_info["label"] = item_info["response"]
-        return item_info
+        return self.store.record(index)
 
     def __len__(self):
-        return len(self.data)
+        return len(self.store)
+
+
+class PretokenizedDataset(Dataset):
+    def __init__(self, store):
+        """Pairs pretokenized by utils/pretokenize.py; items are views into the mapped arrays."""
+        self.ids = store["ids"]
+        self.offsets = store["offsets"]
+        self.source_lens = store["source_lens"]
+
+    def __getitem__(self, index):
+        return {"input_ids": self.ids[self.offsets[index]:self.offsets[index + 1]], "source_len": int(self.source_lens[index])}
+
+    def __len__(self):
+        return len(self.source_lens)
+
+
+class LengthGroupedBatchSampler:
+    """Batches of samples of similar input length, longest first, so that padding every batch
+    to its longest input pads little. Batches are yielded as lists of dataset indices."""
+    def __init__(self, lengths, batch_size):
+        order = np.argsort(-np.asarray(lengths), kind="stable")
+        self.batches = [order[start:start + batch_size].tolist() for start in range(0, len(order), batch_size)]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
 
 
 class NerCollate:
@@ -131,6 +258,24 @@ class NerCollate:
         labels = torch.tensor(all_labels)
         return {'input_ids': input_ids, 'labels': labels}
     
+    def padding_tokenized(self, batch):
+        """padding_pairs for PretokenizedDataset items: only slices and pads."""
+        length_list = []
+        for example in batch:
+            source_len = example["source_len"]
+            if source_len > self.max_tokens:
+                self.max_tokens = source_len
+            self.total_tokens = self.total_tokens + source_len
+            length_list.append(len(example["input_ids"]))
+        max_length = min(max(length_list), self.max_seq_length)
+        input_ids = torch.full((len(batch), max_length), self.tokenizer.pad_token_id, dtype=torch.long)
+        labels = torch.full((len(batch), max_length), IGNORE_INDEX, dtype=torch.long)
+        for i, example in enumerate(batch):
+            ids = torch.from_numpy(np.asarray(example["input_ids"][:max_length], dtype=np.int64))
+            input_ids[i, :len(ids)] = ids
+            labels[i, example["source_len"]:len(ids)] = ids[example["source_len"]:]
+        return {'input_ids': input_ids, 'labels': labels}
+
     def padding_inputs(self, sources):
         results = self.tokenizer.batch_encode_plus(sources, return_tensors="pt", padding=True)
         return results
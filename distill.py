@@ -0,0 +1,164 @@
+"""Distil the rsum memory update into a small local summarizer.
+
+1. harvest: collect (previous memory, dialogue context, updated memory) triples from
+   memory-update call logs (main_chatgpt.py --distill_log ...) and from the per-session
+   memory files of cached GPT runs under save_msc/<model_name>/.
+       python distill.py --operation harvest --model_name gpt-4o-2024-05-13 --distill_log save_msc/calls.jsonl
+2. distill: fine-tune a small causal LM with LoRA (loaded through main_llama.build_model).
+       python distill.py --operation distill --model_name Qwen/Qwen2.5-0.5B-Instruct
+3. use it as the update_summary backend:
+       python main_chatgpt.py --mode rsum --summary_backend local --load_path save_msc/distill_lora ...
+"""
+import glob
+import json
+import os
+import pickle
+import random
+import re
+from functools import partial
+
+from config import get_args, get_logger
+
+# the memory files of cached runs and of chained runs (main_chatgpt.py --session_id 2-5)
+re_sum_file = re.compile(r'(?:summary_dicts|.*_chain_mem)_sid(\d+)\.(pkl|json)$')
+
+
+def harvest_call_logs(path):
+    triples = []
+    if not path or not os.path.exists(path):
+        return triples
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            triples.append({"prompt": record["prompt"], "prev_memory": record["prev_memory"],
+                            "context": record["context"], "memory": record["memory"]})
+    return triples
+
+
+def harvest_session_files(args, model_dir):
+    """Join the memories of consecutive sessions with the last window of the later session."""
+    from chatgpt.data_loader import read_msc_data
+    from main_chatgpt import make_summary_prompt
+
+    memories = {}
+    for path in glob.glob(os.path.join(model_dir, "*")):
+        match = re_sum_file.match(os.path.basename(path))
+        if match is None:
+            continue
+        if path.endswith(".pkl"):
+            with open(path, "rb") as fr:
+                memories.setdefault(int(match.group(1)), {}).update(pickle.load(fr))
+        else:
+            with open(path, "r", encoding="utf-8") as fr:
+                memories.setdefault(int(match.group(1)), {}).update(json.load(fr))
+
+    triples = []
+    for session_id in sorted(memories):
+        if session_id - 1 not in memories:
+            continue
+        path_test = f'data/msc/msc/msc_dialogue/session_{session_id}/test.txt'
+        if not os.path.exists(path_test):
+            continue
+        for test_dial in read_msc_data(args, path_test):
+            init_dial_id = test_dial["dial_id"].split("-")[0]
+            if not test_dial["last_turn"] or init_dial_id not in memories[session_id - 1] \
+                    or init_dial_id not in memories[session_id]:
+                continue
+            prev_memory, memory = memories[session_id - 1][init_dial_id], memories[session_id][init_dial_id]
+            if not isinstance(prev_memory, str) or not isinstance(memory, str):
+                continue
+            # the memory is not updated after the last session (5), so these pairs only copy their input
+            if memory.strip() == prev_memory.strip():
+                continue
+            triples.append({
+                "prompt": make_summary_prompt(args, context=test_dial["window"], summary=prev_memory),
+                "prev_memory": prev_memory,
+                "context": test_dial["window"],
+                "memory": memory,
+                "dial_id": f"{init_dial_id}-sid{session_id}",
+            })
+    return triples
+
+
+def harvest(args):
+    triples = harvest_call_logs(args.distill_log)
+    triples += harvest_session_files(args, os.path.join("save_msc", args.model_name))
+    seen, unique = set(), []
+    for triple in triples:
+        if triple["prompt"] not in seen and triple["memory"].strip():
+            seen.add(triple["prompt"])
+            unique.append(triple)
+    os.makedirs(os.path.dirname(args.distill_file) or ".", exist_ok=True)
+    with open(args.distill_file, "w", encoding="utf-8") as f:
+        for triple in unique:
+            f.write(json.dumps(triple, ensure_ascii=False) + "\n")
+    print(f"#Harvested {len(unique)} triples into {args.distill_file}")
+
+
+def distill(args):
+    import torch
+    from torch.utils.data import DataLoader
+    from peft import LoraConfig, get_peft_model
+    from dataset import PretokenizedDataset, NerCollate
+    from main_llama import build_model
+    from utils.pretokenize import pretokenize
+
+    with open(args.distill_file, "r", encoding="utf-8") as f:
+        data = [json.loads(line) for line in f]
+    random.seed(args.random_seed)
+    random.shuffle(data)
+    num_dev = max(1, len(data) // 10)
+    data_train, data_dev = data[num_dev:], data[:num_dev]
+
+    model, tokenizer = build_model(args)
+    model = get_peft_model(model, LoraConfig(r=args.lora_r, lora_alpha=2 * args.lora_r, lora_dropout=0.05,
+                                             task_type="CAUSAL_LM"))
+    model.print_trainable_parameters()
+    nercollate = NerCollate(args, tokenizer)
+
+    def pretokenized(name, data):
+        store = pretokenize(args, name, [item["prompt"] for item in data],
+                            [item["memory"] + tokenizer.eos_token for item in data], tokenizer)
+        return PretokenizedDataset(store)
+
+    train_loader = DataLoader(pretokenized("distill_train", data_train), batch_size=args.train_batch_size, shuffle=True,
+                              collate_fn=nercollate.padding_tokenized)
+    dev_loader = DataLoader(pretokenized("distill_dev", data_dev), batch_size=args.dev_batch_size, shuffle=False,
+                            collate_fn=nercollate.padding_tokenized)
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=args.learning_rate)
+    save_path = os.path.join(args.saving_dir, "distill_lora")
+    best_loss = float("inf")
+    for epoch in range(args.n_epoch):
+        model.train()
+        for step, batch in enumerate(train_loader):
+            batch = {k: v.to(model.device) for k, v in batch.items()}
+            loss = model(**batch).loss / args.gradient_accumulation_steps
+            loss.backward()
+            if (step + 1) % args.gradient_accumulation_steps == 0 or step + 1 == len(train_loader):
+                optimizer.step()
+                optimizer.zero_grad()
+        model.eval()
+        losses = []
+        with torch.no_grad():
+            for batch in dev_loader:
+                batch = {k: v.to(model.device) for k, v in batch.items()}
+                losses.append(model(**batch).loss.item())
+        dev_loss = sum(losses) / len(losses)
+        args.logger.info(f"epoch {epoch}: dev loss {dev_loss:.4f}")
+        if dev_loss < best_loss:
+            best_loss = dev_loss
+            model.save_pretrained(save_path)
+            tokenizer.save_pretrained(save_path)
+    args.logger.info(f"saved the distilled summarizer to {save_path}")
+
+
+if __name__ == "__main__":
+    args = get_args()
+    if args.saving_dir == "save":
+        args.saving_dir = "save_msc"
+    os.makedirs(args.saving_dir, exist_ok=True)
+    args.logger = get_logger(os.path.join(args.saving_dir, "distill.log"), "a")
+    if args.operation == "harvest":
+        harvest(args)
+    elif args.operation == "distill":
+        distill(args)
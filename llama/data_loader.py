@@ -4,6 +4,7 @@ import random
 from torch.utils.data.distributed import DistributedSampler
 from functools import partial
 from utils.evaluation import compute_f1, compute_f1_sentence
+from utils.persona_merge import merge_personas, summary_windows
 import copy
 import math
 from tqdm import tqdm
@@ -158,29 +159,6 @@ def read_care_data(args, path_name):
 
     return data_train, data_dev, data_test
 
-def count_data(path_name):
-    with open(path_name, "r") as f:
-        raw_data = [json.loads(line.strip()) for line in f]
-    count = 0
-    token_num = 0
-    for dial in raw_data:
-        history = []
-        prev_dialogs = dial["previous_dialogs"]
-        for prev in prev_dialogs:
-            for idx, item in enumerate(prev["dialog"]):
-                if idx % 2 == 0:
-                    history.append("User: " + item["text"])
-                else:
-                    history.append("System: " + item["text"])
-        for idx, item in enumerate(dial["dialog"]):
-            if item["id"] == "Speaker 2":
-                token_num += len(" ".join(history).split(" "))
-                count += 1
-            speaker_id, speaker_text = item["id"], item["text"]
-            history.append(f"{speaker_id}: {speaker_text}")
-
-    return token_num / count * 1.00
-
 def prepare_test_data(args):
     if args.dataset == "msc":
         path_test = f'data/msc/msc/msc_dialogue/session_{args.session_id}/test.txt'
@@ -292,25 +270,6 @@ def read_sum_data(args, path_name, data_type):
     max_tokens = 0
     sum_tokens = 0
     count_data = 0
-    def merge_personas(init_personas, add_personas):
-        new_personas = [] 
-        if add_personas[0] == [] and add_personas[1] == []:
-            return init_personas
-
-        for i in range(2):
-            personas_i = init_personas[i].copy()
-            for ip in add_personas[i]:
-                found = False
-                for j, op in enumerate(personas_i):
-                    if compute_f1_sentence(ip, op) > 0.5:
-                        personas_i[j] = ' '.join([op, ip])
-                        found = True
-                        break
-                if not found:
-                    personas_i.append(ip)
-
-            new_personas.append(personas_i.copy())
-        return new_personas
     
 
     def get_person_string(personas_list):
@@ -328,33 +287,15 @@ def read_sum_data(args, path_name, data_type):
         init_personachat = dialog_dict['init_personachat']
         init_personas = init_personachat['init_personas']
         init_persona_string = get_person_string(init_personas)
-        for end_idx in range(len(current_episode)):
-            if args.summary_num_turns > 0:
-                start_index = max(0, end_idx - args.summary_num_turns + 1)
-            else:
-                start_index = 0
-
-            add_personas = [[],[]]
+        for end_idx, dialog_texts, end_personas in summary_windows(current_episode, init_personas,
+                                                                   args.summary_num_turns, 0.5):
             end_line_persona = (
                 current_episode[end_idx]['persona_text']
                 if 'persona_text' in current_episode[end_idx]
                 else NOPERSONA
                 )
-            
-            idx1, idx2 = end_idx, end_idx - 1
-            r1, r2 = idx1 % 2 , idx2 % 2 
-            add_personas[r1] = current_episode[idx1]['agg_persona_list']
-            if idx2 >= 0 :
-                add_personas[r2] = current_episode[idx2]['agg_persona_list']
-
-            end_personas = merge_personas(init_personas, add_personas)
             end_persona_string = get_person_string(end_personas)
 
-            dialog_texts = []
-            for i in range(start_index, end_idx + 1):
-                prefix = "partner: " if i % 2 == 0 else "you: "
-                dialog_texts.append(f'{prefix}{current_episode[i]["text"]}')
-
             action = {
                 'context': '\n'.join(dialog_texts),
                 'labels': end_persona_string,
@@ -1,16 +1,24 @@
-from chatgpt.data_loader import prepare_data, prepare_test_data
+from chatgpt.data_loader import prepare_data, prepare_test_data, read_msc_data, load_example
 from config import get_args, get_logger
 from chatgpt.robot import gpt_summary_results, gpt_response_results, davinci_response_results, davinci_summary_results
 from tqdm import tqdm
-from utils.evaluation import compute_f1, calc_distinct
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils.evaluation import compute_f1, calc_distinct, evaluate_corpus
+from utils.fact_memory import FactMemory, parse_facts
+from utils.memory_select import select_memory, selection_report, compare_selection
+from utils.memory_store import MemoryStore
+from utils.snapshot_store import SnapshotArchive
+from utils.local_summarizer import local_summary_results
+from utils.parallel_load import load_parallel
+from utils.planner import recorder, dry_summary_results, dry_response_results, plan_report, print_plan
+from utils.prompts import get_prompt
 import time
+import threading
 import pickle
 import os, json
 
-predefined_prompts = json.load(open("prompt.json"))
-
-def update_summary(args, context="", summary="", example=""):
-    instruction = predefined_prompts[args.dataset]['gpt-3.5-turbo']["update_memory"]
+def make_summary_prompt(args, context="", summary="", example=""):
+    instruction = get_prompt("rsum", args.dataset, "gpt-3.5-turbo", "update_memory")
     if args.do_ict:
         prompt = f"**Instruction** {instruction}\n " \
                  f"**Examples** {example}\n " \
@@ -18,15 +26,89 @@ def update_summary(args, context="", summary="", example=""):
     else:
         prompt = f"**Instruction** {instruction}\n " \
                  f"**Test** [Previous Memory] {summary} [Dialogue Context] {context} [Updated Memory]"
-    if "gpt" in args.model_name:
+    return prompt
+
+def update_summary(args, context="", summary="", example=""):
+    prompt = make_summary_prompt(args, context=context, summary=summary, example=example)
+    if args.dry_run:
+        result = dry_summary_results(args, prompt)
+    elif args.summary_backend == "local":
+        result = local_summary_results(args, prompt)
+    elif "gpt" in args.model_name:
         result = gpt_summary_results(args, prompt)
     elif "davinci" in args.model_name:
         result = davinci_summary_results(args, prompt)
     result = result.replace("\n", "")
+    if args.distill_log and not args.dry_run:
+        log_summary_call(args, prompt, summary, context, result)
     return result
 
-def update_response(args, summary="", context="", example=""):
-    instruction = predefined_prompts[args.dataset]['gpt-3.5-turbo']["update_response"]
+distill_lock = threading.Lock()
+
+def log_summary_call(args, prompt, summary, context, result):
+    """Append one (previous memory, context, updated memory) triple for distill.py."""
+    record = {"model": args.model_name, "prompt": prompt, "prev_memory": str(summary), "context": context, "memory": result}
+    with distill_lock:
+        with open(args.distill_log, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+def update_fact_memory(args, context="", memory=None):
+    """Extract only the new facts of the context and merge them into a FactMemory."""
+    instruction = get_prompt("rsum", args.dataset, "gpt-3.5-turbo", "extract_facts")
+    prompt = f"**Instruction** {instruction}\n " \
+             f"**Test** [Dialogue Context] {context} [New Facts]"
+    if args.dry_run:
+        result = dry_summary_results(args, prompt)
+    elif "gpt" in args.model_name:
+        result = gpt_summary_results(args, prompt)
+    elif "davinci" in args.model_name:
+        result = davinci_summary_results(args, prompt)
+    if isinstance(memory, dict):
+        memory = FactMemory.from_dict(memory)
+    elif not isinstance(memory, FactMemory):
+        memory = FactMemory.from_text(memory or "")
+    memory.update(parse_facts(result))
+    return memory
+
+def update_memory(args, context="", memory="", example=""):
+    if args.memory_type == "facts":
+        return update_fact_memory(args, context=context, memory=memory)
+    return update_summary(args, context=context, summary=memory, example=example)
+
+def dump_memory(memory):
+    if isinstance(memory, FactMemory):
+        return memory.to_dict()
+    return memory
+
+def load_memory(memory):
+    if isinstance(memory, dict):
+        return FactMemory.from_dict(memory)
+    return memory
+
+# save_memory runs on the summary_chain worker threads, so the store is created under a lock
+memory_store_lock = threading.Lock()
+
+def get_memory_store(args):
+    with memory_store_lock:
+        if getattr(args, "memory_store", None) is None:
+            args.memory_store = MemoryStore(args.memory_db)
+        return args.memory_store
+
+def close_memory_store(args):
+    """Commit the queued memories and stop the store's writer thread."""
+    with memory_store_lock:
+        store = getattr(args, "memory_store", None)
+        args.memory_store = None
+    if store is not None:
+        store.close()
+
+def save_memory(args, init_dial_id, session_id, memory):
+    if args.memory_db and not args.dry_run:
+        get_memory_store(args).put(init_dial_id, session_id, dump_memory(memory))
+
+def make_response_prompt(args, summary="", context="", example=""):
+    summary = select_memory(args, summary, context)
+    instruction = get_prompt("rsum", args.dataset, "gpt-3.5-turbo", "update_response")
     if args.do_ict:
         prompt = f"**Instruction** {instruction}\n " \
                  f"**Examples** {example}\n " \
@@ -34,8 +116,13 @@ def update_response(args, summary="", context="", example=""):
     else:
         prompt = f"**Instruction** {instruction}\n " \
                  f"**Test** [Previous Memory] {summary} [Dialogue Context] {context} [Response] \n"
+    return prompt
 
-    if "gpt" in args.model_name:
+def update_response(args, summary="", context="", example=""):
+    prompt = make_response_prompt(args, summary=summary, context=context, example=example)
+    if args.dry_run:
+        result = dry_response_results(args, prompt)
+    elif "gpt" in args.model_name:
         result = gpt_response_results(args, prompt)
     elif "davinci" in args.model_name:
         result = davinci_response_results(args, prompt)
@@ -44,7 +131,7 @@ def update_response(args, summary="", context="", example=""):
     return result
 
 def make_direct_response(args, context, example):
-    instruction = predefined_prompts[args.dataset]['gpt-3.5-turbo']["direct_response"]
+    instruction = get_prompt("rsum", args.dataset, "gpt-3.5-turbo", "direct_response")
     if args.do_ict:
         prompt = f"**Instruction** {instruction}\n " \
                  f"**Examples** {example}\n " \
@@ -52,7 +139,9 @@ def make_direct_response(args, context, example):
     else:
         prompt = f"**Instruction** {instruction}\n " \
                  f"**Test** [Dialogue Context] {context} [Response] "
-    if "gpt" in args.model_name:
+    if args.dry_run:
+        result = dry_response_results(args, prompt)
+    elif "gpt" in args.model_name:
         result = gpt_response_results(args, prompt)
     elif "davinci" in args.model_name:
         result = davinci_response_results(args, prompt)
@@ -62,18 +151,28 @@ def make_direct_response(args, context, example):
 
 def load_prev_summary(args):
     prev_session = args.session_id - 1
+    if args.memory_db:
+        return get_memory_store(args).session(prev_session)
+    # carecall always starts from the memories inferred for session 5, the archive as well as the files
+    snapshot_session = prev_session if args.dataset == 'msc' else 5
+    if args.memory_archive:
+        archive = SnapshotArchive(args.memory_archive)
+        model = 'gpt-3.5-old/summary_dicts' if args.dataset == 'msc' else f'{os.path.basename(args.saving_dir)}/infer_sum'
+        summary_dict = archive.session(model, snapshot_session)
+        archive.close()
+        return summary_dict
     if args.dataset == 'msc':
-        with open(os.path.join(f'save_msc/gpt-3.5-old', f"summary_dicts_sid{prev_session}.pkl"), 'rb') as fr:
+        with open(os.path.join(f'save_msc/gpt-3.5-old', f"summary_dicts_sid{snapshot_session}.pkl"), 'rb') as fr:
             summary_dict = pickle.load(fr)
     else:
-        with open(os.path.join(f'{args.saving_dir}', f"infer_sum_sid5.json"), 'rb') as fr:
+        with open(os.path.join(f'{args.saving_dir}', f"infer_sum_sid{snapshot_session}.json"), 'rb') as fr:
             summary_dict = json.load(fr)
     return summary_dict
 
 def get_prev_summary(args, dial, example):
-    prev_summary = "Empty"
+    prev_summary = FactMemory() if args.memory_type == "facts" else "Empty"
     for idx, prev in enumerate(dial["prev_list"]):
-        prev_summary = update_summary(args=args, context=prev, summary=prev_summary, example=example)
+        prev_summary = update_memory(args=args, context=prev, memory=prev_summary, example=example)
     return prev_summary
 
 def summary_all(args, prefix="sumall"):
@@ -82,7 +181,6 @@ def summary_all(args, prefix="sumall"):
     predictions = []
     references = []
     mem_preds, mem_labels = [], []
-    summary_file = open(os.path.join(args.saving_dir, f"{prefix}_summary.txt"), "w")
     args.logger = get_logger('{}/{}.log'.format(args.saving_dir, args.mode), "a")
     args.logger.info(args)
     pred_dicts = {}
@@ -101,6 +199,7 @@ def summary_all(args, prefix="sumall"):
     for idx, test_dial in enumerate(tqdm(test_data)):
         cur_dial_id = test_dial["dial_id"]
         init_dial_id = cur_dial_id.split("-")[0]
+        recorder.set_chain(init_dial_id)
 
         if args.dataset == 'msc':
             if test_dial["first_turn"]:
@@ -108,13 +207,13 @@ def summary_all(args, prefix="sumall"):
                 if prev_summary_dicts is None or init_dial_id not in prev_summary_dicts:
                     summary_text = get_prev_summary(args, test_dial, ex_summ)
                 else:
-                    summary_text = prev_summary_dicts[init_dial_id]
+                    summary_text = load_memory(prev_summary_dicts[init_dial_id])
         else:
             if prev_summary_dicts is not None and init_dial_id in prev_summary_dicts:
-                summary_text = prev_summary_dicts[init_dial_id]
+                summary_text = load_memory(prev_summary_dicts[init_dial_id])
             else:
                 summary_text = get_prev_summary(args, test_dial, ex_summ)
-                summary_dict[init_dial_id] = summary_text
+                summary_dict[init_dial_id] = dump_memory(summary_text)
             
 
         response = update_response(args, summary=summary_text, context=test_dial["window"], example=ex_resp)
@@ -125,9 +224,12 @@ def summary_all(args, prefix="sumall"):
 
         #the summary will be updated at the last turn.
         if test_dial["last_turn"] and args.session_id != 5:
-            summary_text = update_summary(args, context=test_dial["window"], summary=summary_text)
-            curr_summary_dicts[cur_dial_id] = summary_text
+            summary_text = update_memory(args, context=test_dial["window"], memory=summary_text)
+            curr_summary_dicts[cur_dial_id] = dump_memory(summary_text)
+            save_memory(args, init_dial_id, args.session_id, summary_text)
 
+    if args.dry_run:
+        return
 
     wfile= os.path.join(args.saving_dir, f"{args.operation}_{args.mode}_sid{args.session_id}.json")
     with open(wfile,"w", encoding='utf-8') as f: 
@@ -137,14 +239,120 @@ def summary_all(args, prefix="sumall"):
     with open(wfile,"w", encoding='utf-8') as f: 
         f.write(json.dumps(summary_dict, ensure_ascii=False, indent=4))  
 
+    if args.memory_db:
+        close_memory_store(args)
+    report_selection(args, predictions, references, f"{args.operation}_{args.mode}_sid{args.session_id}")
     #print_eval_metrics(args, predictions, references, mem_preds, mem_labels)
 
+def report_selection(args, predictions, references, name):
+    """Log the metrics of the run next to those of the --memory_select none run of the same setup."""
+    results = evaluate_corpus(predictions, references)
+    result = {k: round(v * 100, 4) for k, v in results.items()}
+    if args.memory_select != "none":
+        result.update(selection_report())
+    result = compare_selection(args, result, name)
+    args.logger.info(f"memory_select={args.memory_select} topk={args.memory_topk} budget={args.memory_budget}: {result}")
+
+def group_by_dialogue(test_data):
+    dialogs = {}
+    for test_dial in test_data:
+        init_dial_id = test_dial["dial_id"].split("-")[0]
+        dialogs.setdefault(init_dial_id, []).append(test_dial)
+    return dialogs
+
+def summary_chain(args):
+    """Run rsum over several sessions in one process.
+
+    Every dialogue is a single task which walks through all sessions in order, so the
+    memory produced at the end of session k is handed to session k+1 directly and a
+    dialogue never waits for the others to finish their current session.
+    """
+    if args.dataset != 'msc':
+        raise ValueError("chained sessions are only supported for msc")
+    args.logger = get_logger('{}/{}.log'.format(args.saving_dir, args.mode), "a")
+    args.logger.info(args)
+
+    paths = [f'data/msc/msc/msc_dialogue/session_{session_id}/test.txt' for session_id in args.session_ids]
+    session_data = load_parallel(args, [(read_msc_data, path_test) for path_test in paths])
+    session_dialogs = {session_id: group_by_dialogue(data) for session_id, data in zip(args.session_ids, session_data)}
+    ex_summ, ex_resp = "", ""
+    if args.do_ict:
+        example = load_example(args, 'data/msc/msc/msc_dialogue/session_2/valid.txt')
+        ex_summ = example["update_summary"]
+        ex_resp = example["update_response"]
+
+    first_session = args.session_ids[0]
+    prev_summary_dicts = None
+    if first_session > 2:
+        prev_summary_dicts = load_prev_summary(args)
+
+    def run_dialogue(init_dial_id):
+        recorder.set_chain(init_dial_id)
+        pred_dicts = {session_id: {} for session_id in args.session_ids}
+        summary_dicts = {}
+        summary_text = None
+        for session_id in args.session_ids:
+            turns = session_dialogs[session_id].get(init_dial_id)
+            if turns is None:
+                break
+            for test_dial in turns:
+                if summary_text is None:
+                    if prev_summary_dicts is None or init_dial_id not in prev_summary_dicts:
+                        summary_text = get_prev_summary(args, test_dial, ex_summ)
+                    else:
+                        summary_text = load_memory(prev_summary_dicts[init_dial_id])
+                response = update_response(args, summary=summary_text, context=test_dial["window"], example=ex_resp)
+                pred_dicts[session_id][test_dial["dial_id"]] = {'prediction': response, 'label': test_dial["label"]}
+                if test_dial["last_turn"] and session_id != 5:
+                    summary_text = update_memory(args, context=test_dial["window"], memory=summary_text)
+            summary_dicts[session_id] = dump_memory(summary_text)
+            save_memory(args, init_dial_id, session_id, summary_text)
+        return pred_dicts, summary_dicts
+
+    all_preds = {session_id: {} for session_id in args.session_ids}
+    all_summaries = {session_id: {} for session_id in args.session_ids}
+    dial_ids = list(session_dialogs[first_session].keys())[:args.test_num]
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = {executor.submit(run_dialogue, dial_id): dial_id for dial_id in dial_ids}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            init_dial_id = futures[future]
+            pred_dicts, summary_dicts = future.result()
+            for session_id in args.session_ids:
+                all_preds[session_id].update(pred_dicts[session_id])
+                if session_id in summary_dicts:
+                    all_summaries[session_id][init_dial_id] = summary_dicts[session_id]
+    if args.dry_run:
+        return
+
+    for session_id in args.session_ids:
+        # keep the dataset order in the output files, not the completion order
+        pred_dicts = {}
+        for turns in session_dialogs[session_id].values():
+            for turn in turns:
+                if turn["dial_id"] in all_preds[session_id]:
+                    pred_dicts[turn["dial_id"]] = all_preds[session_id][turn["dial_id"]]
+        wfile= os.path.join(args.saving_dir, f"{args.operation}_{args.mode}_sid{session_id}.json")
+        with open(wfile,"w", encoding='utf-8') as f:
+            f.write(json.dumps(pred_dicts, ensure_ascii=False, indent=4))
+
+        # not {op}_sum_sid{k}.json, which summary_all writes with other content
+        wfile= os.path.join(args.saving_dir, f"{args.operation}_chain_mem_sid{session_id}.json")
+        with open(wfile,"w", encoding='utf-8') as f:
+            f.write(json.dumps(all_summaries[session_id], ensure_ascii=False, indent=4))
+        args.logger.info(f"session {session_id}: {len(pred_dicts)} responses, {len(all_summaries[session_id])} memories")
+
+    if args.memory_db:
+        close_memory_store(args)
+    predictions = [pred["prediction"] for session_id in args.session_ids for pred in all_preds[session_id].values()]
+    references = [pred["label"] for session_id in args.session_ids for pred in all_preds[session_id].values()]
+    report_selection(args, predictions, references, f"{args.operation}_{args.mode}_sid{'-'.join(map(str, args.session_ids))}")
+
 def summary_gold(args, prefix="sumgold"):
     test_data, example = prepare_test_data(args)
     predictions = []
     references = []
-    refs_file = open(os.path.join(args.saving_dir, f"{prefix}_refs.txt"), "w")
-    hyps_file = open(os.path.join(args.saving_dir, f"{prefix}_hyps.txt"), "w")
+    refs_file = open_output(args, f"{prefix}_refs.txt", "w")
+    hyps_file = open_output(args, f"{prefix}_hyps.txt", "w")
     args.logger = get_logger('{}/{}.log'.format(args.saving_dir, args.mode), "a")
     args.logger.info(args)
 
@@ -162,8 +370,16 @@ def summary_gold(args, prefix="sumgold"):
         hyps_file.writelines(response + "\n")
     refs_file.close()
     hyps_file.close()
+    if args.dry_run:
+        return
     print_eval_metrics(args, predictions, references, [], [])
 
+def open_output(args, name, mode):
+    # a dry run renders the prompts only, its placeholder outputs are not worth keeping
+    if args.dry_run:
+        return open(os.devnull, mode)
+    return open(os.path.join(args.saving_dir, name), mode)
+
 def make_file_name(args):
     prefix = args.mode
     if args.do_ict:
@@ -178,9 +394,9 @@ def summary_sample(args):
     references = []
     mem_preds, mem_labels = [], []
     prefix = make_file_name(args)
-    refs_file = open(os.path.join(args.saving_dir, f"{args.dataset}_{prefix}_refs.txt"), "a")
-    hyps_file = open(os.path.join(args.saving_dir, f"{prefix}_hyps.txt"), "a")
-    summary_file = open(os.path.join(args.saving_dir, f"{prefix}_summary.txt"), "a")
+    refs_file = open_output(args, f"{args.dataset}_{prefix}_refs.txt", "a")
+    hyps_file = open_output(args, f"{prefix}_hyps.txt", "a")
+    summary_file = open_output(args, f"{prefix}_summary.txt", "a")
     args.logger = get_logger('{}/{}.log'.format(args.saving_dir, args.mode), "w")
     for idx, test_dial in enumerate(tqdm(test_data)):
         if idx <= 49:
@@ -205,6 +421,8 @@ def summary_sample(args):
     refs_file.close()
     hyps_file.close()
     summary_file.close()
+    if args.dry_run:
+        return
     print_eval_metrics(args, predictions, references, mem_preds, mem_labels)
 
 
@@ -220,6 +438,8 @@ def direct_response(args, prefix="direct"):
         response = make_direct_response(args, test_dial[args.mode], examples[args.mode])
         pred_dicts[dial_id] = {'prediction': response, 'label': test_dial["label"]}
 
+    if args.dry_run:
+        return
     wfile= os.path.join(args.saving_dir, f"{args.operation}_{args.mode}_sid{args.session_id}.json")
     with open(wfile,"w", encoding='utf-8') as f: 
         f.write(json.dumps(pred_dicts, ensure_ascii=False, indent=4))  
@@ -248,10 +468,14 @@ if __name__ == "__main__":
     if args.mode == "rsum":
         if args.do_sample:
             summary_sample(args)
+        elif len(args.session_ids) > 1:
+            summary_chain(args)
         else:
             summary_all(args)
     elif args.mode == "sumgold":
         summary_gold(args)
     elif args.mode in ["full", "window"]:
         direct_response(args)
+    if args.dry_run:
+        print_plan(args, plan_report(args))
 
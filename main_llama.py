@@ -9,15 +9,21 @@ from torch.distributed.fsdp import (
 from utils.robot import gpt_response_results, gpt_memory_results
 from utils.llm_judge import run_llm_judge, load_eval_file, run_llm_win
 from tqdm import tqdm
-from dataloader import load_dataset
-from dataset import NerCollate
+from dataloader import load_dataset, test_source
+from dataset import NerCollate, LengthGroupedBatchSampler, PretokenizedDataset, PackedDataset
 from config import get_args
 import json
 import tiktoken
 from transformers import LlamaTokenizer, LlamaForCausalLM, TrainerCallback, AutoModel, AutoTokenizer, AutoModelForCausalLM, AutoConfig
 from transformers.generation.utils import GenerationConfig
 from utils.evaluation import compute_f1, evaluate_corpus, evaluate_memory
-from torch.utils.data import DataLoader, Dataset, RandomSampler, SequentialSampler
+from utils.memory_select import select_memory, selection_report, compare_selection
+from utils.corpus import Corpus
+from utils.planner import recorder, RESPONSE_TOKENS, dry_summary_results, dry_response_results, plan_report, print_plan
+from utils.prompts import get_prompt, get_template
+from utils.token_lengths import length_index
+from utils.pretokenize import pretokenize
+from torch.utils.data import DataLoader, Dataset, RandomSampler, SequentialSampler, BatchSampler
 import torch.distributed as dist
 #from chatgpt.robot import gpt_response_results
 from peft import (
@@ -40,8 +46,6 @@ model_dict = {"baichuan": "baichuan_13B",
               "chatglm":"chatglm2_6b",
               "vicuna":"vicuna-7b"}
 
-prompts = json.load(open("data/msc/msc/msc_dialogue/prompts.json", "r"))
-
 def build_model(args):
     model, tokenizer = None, None
     if "llama" in args.model_name:
@@ -96,6 +100,14 @@ def build_model(args):
         model = model.to(device)
         tokenizer = AutoTokenizer.from_pretrained(f"/data/zhuxiaowei/project/Mymodel/{model_dict[args.model_name]}", trust_remote_code=True, revision="")
 
+    elif os.path.isdir(args.model_name) or "/" in args.model_name:
+        # any other causal LM given as a local directory or a hub id, e.g. the small distilled summarizer
+        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        tokenizer = AutoTokenizer.from_pretrained(args.model_name, padding_side="left")
+        model = AutoModelForCausalLM.from_pretrained(args.model_name).to(device)
+        if tokenizer.pad_token_id is None:
+            tokenizer.pad_token = tokenizer.eos_token
+
     return model, tokenizer
 
 def model_chat(args, inputs, model, tokenizer=None, logprobs=False):
@@ -149,7 +161,7 @@ def sum_api(args):
             print(1)
             prev_memory = "EMPTY"
             for history in histories:
-                prompt_str = prompts['gpt-3.5-turbo']['gen_memory1'].format_map({"prev_memory": prev_memory, "dialog": history})
+                prompt_str = get_template("msc", "gpt-3.5-turbo", "gen_memory1").format_map({"prev_memory": prev_memory, "dialog": history})
                 prev_memory = gpt_memory_results(prompt_str, args.model_name)
                 pred_dict[dial_id].append(prev_memory)
         else:
@@ -192,9 +204,11 @@ def evaluate_file(args, filename=False):
     else:
         fileHandler = open(f"{args.saving_dir}/{args.dataset}_{args.operation}_{args.mode}_sid{args.session_id}.json",  "r")
     pred_dicts = json.load(fileHandler)
+    seen = set()
     for keys,values in tqdm(pred_dicts.items()):
         dial_id, label, result = keys, values["label"], values["prediction"]
-        if dial_id not in dial_ids:
+        if dial_id not in seen:
+            seen.add(dial_id)
             dial_ids.append(dial_id)
             labels.append(label)
             predictions.append(result)
@@ -205,29 +219,39 @@ def evaluate_file(args, filename=False):
 
 
 def chat_model(args):
-    test_dataset = load_dataset(args)
+    test_data, test_dataset = load_dataset(args)
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     model, tokenizer = build_model(args)
     model.eval()
     nercollate = NerCollate(args, tokenizer)
-    test_dataloader = DataLoader(test_dataset, batch_size=args.test_batch_size, shuffle=False, collate_fn = nercollate.collate_fn)
-    all_preds = []
+    if args.length_grouping:
+        # batch prompts of similar length together; predictions are put back in dataset order below
+        loader, params = test_source(args)
+        lengths = length_index(args, loader, *params, tokenizer=tokenizer, samples=test_data)
+        batch_sampler = LengthGroupedBatchSampler(test_dataset.input_lengths(lengths), args.test_batch_size)
+    else:
+        batch_sampler = BatchSampler(SequentialSampler(test_dataset), args.test_batch_size, drop_last=False)
+    # workers read the prompts from one shared byte buffer instead of copying the sample objects
+    loader_dataset = PackedDataset(test_dataset) if args.num_workers > 0 else test_dataset
+    test_dataloader = DataLoader(loader_dataset, batch_sampler=batch_sampler, collate_fn = nercollate.collate_fn,
+                                 num_workers=args.num_workers, persistent_workers=args.persistent_workers and args.num_workers > 0)
+    all_preds = [None] * len(test_dataset)
     all_trues = []
     pred_dicts = {}
     split_str = test_dataset.prompt.split("\n")[-1]
     #import pdb;pdb.set_trace()
     with torch.no_grad():
-        for step, batch in enumerate(tqdm(test_dataloader, ncols=100)):
+        for indices, batch in zip(batch_sampler, tqdm(test_dataloader, ncols=100)):
             for k,v in batch.items():
                 batch[k] = v.to(device)
             #import pdb;pdb.set_trace()
             output = model.generate(**batch, max_new_tokens=100, temperature=0, top_p=0.9)
             decoded_preds = tokenizer.batch_decode(output.cpu(), skip_special_tokens=True)
-            for pred in decoded_preds:
+            for index, pred in zip(indices, decoded_preds):
                 out = pred.split(split_str)[-1].replace("\n","").strip()
                 if "User:" in out:
                     out = out.split("User:")[0]
-                all_preds.append(out)
+                all_preds[index] = out
             #import pdb;pdb.set_trace()
 
     for (data, pred) in zip(test_dataset, all_preds):
@@ -249,9 +273,11 @@ def compute_pll(args):
     nlls = []
     model, tokenizer = build_model(args)
     model.eval()
-    test_dataset = load_dataset(args)
-    nercollate = NerCollate(args, tokenizer,"train")
-    test_dataloader = DataLoader(test_dataset, batch_size=args.test_batch_size, shuffle=False, collate_fn = nercollate.collate_fn)
+    test_data, test_dataset = load_dataset(args)
+    nercollate = NerCollate(args, tokenizer)
+    store = pretokenize(args, f"pll_{args.dataset}_sid{args.session_id}_{args.mode}", [item["input"] for item in test_dataset],
+                        [item["label"] for item in test_dataset], tokenizer)
+    test_dataloader = DataLoader(PretokenizedDataset(store), batch_size=args.test_batch_size, shuffle=False, collate_fn = nercollate.padding_tokenized)
     with torch.no_grad():
         for step, batch in enumerate(tqdm(test_dataloader, ncols=100)):
             for k,v in batch.items():
@@ -266,29 +292,60 @@ def compute_pll(args):
         f.write('PPL:{:.2f} '.format(ppl))
         f.write('#Average Tokens: {:.2f} #Max Tokens: {:.2f}\n'.format(ave_length, nercollate.max_tokens))
 
-def get_response_with_memory(args, test_dial):
+def make_response_with_memory_prompt(args, test_dial):
+    prev_memory = select_memory(args, test_dial['pred_prev_summary'], test_dial['window'])
     if args.operation == 'infer':
-        input_str = prompts['gpt-3.5-turbo']['gen_response_with_memory2'].format_map(
-            {"prev_memory": test_dial['pred_prev_summary'], "dialog": test_dial['window']})
+        input_str = get_template("msc", "gpt-3.5-turbo", "gen_response_with_memory2").format_map(
+            {"prev_memory": prev_memory, "dialog": test_dial['window']})
     elif args.operation == 'ict':
-        input_str = prompts['gpt-3.5-turbo']['gen_response_with_memory_example'].format_map(
-            {"prev_memory": test_dial['pred_prev_summary'], "dialog": test_dial['window'], 'example': prompts['gpt-3.5-turbo']["example3"]})
+        input_str = get_template("msc", "gpt-3.5-turbo", "gen_response_with_memory_example").format_map(
+            {"prev_memory": prev_memory, "dialog": test_dial['window'], 'example': get_prompt("msc", "gpt-3.5-turbo", "example3")})
+    return input_str
+
+
+def get_response_with_memory(args, test_dial):
+    input_str = make_response_with_memory_prompt(args, test_dial)
     #import pdb; pdb.set_trace()
     response = gpt_response_results(args, input_str, args.model_name)
     return response
 
 
-def get_response(args, test_dial):
+def make_response_prompt(args, test_dial):
     if args.mode == 'rag':
-        input_str = prompts['gpt-3.5-turbo']['gen_response_with_rag'].format_map({"dialog": test_dial['window'], 'retrieved': test_dial['rag']})
+        input_str = get_template("msc", "gpt-3.5-turbo", "gen_response_with_rag").format_map({"dialog": test_dial['window'], 'retrieved': test_dial['rag']})
     elif args.mode == 'rag_mem':
-        input_str = prompts['gpt-3.5-turbo']['gen_response_with_rag_memory'].format_map({"dialog": test_dial['window'], 'retrieved': test_dial['rag'], 'prev_memory': test_dial['pred_prev_summary']})
+        input_str = get_template("msc", "gpt-3.5-turbo", "gen_response_with_rag_memory").format_map({"dialog": test_dial['window'], 'retrieved': test_dial['rag'], 'prev_memory': test_dial['pred_prev_summary']})
     else:
-        input_str = prompts['gpt-3.5-turbo']['gen_response'].format_map({"dialog": test_dial[args.mode]})
+        input_str = get_template("msc", "gpt-3.5-turbo", "gen_response").format_map({"dialog": test_dial[args.mode]})
+    return input_str
+
+
+def get_response(args, test_dial):
+    input_str = make_response_prompt(args, test_dial)
     #import pdb; pdb.set_trace()
     response = gpt_response_results(args, input_str, args.model_name)
     return response
 
+
+def plan_run(args, test_dataset):
+    """--dry_run: render the prompts of the run and print the token/cost/time estimate."""
+    for test_dial in tqdm(test_dataset, ncols=100):
+        recorder.set_chain(test_dial['dial_id'].split("-")[0])
+        if 'gpt' not in args.model_name:
+            # local models see the dataset input as is, there is no API price
+            recorder.record("response", test_dial['input'], RESPONSE_TOKENS)
+        elif args.mode == 'sum':
+            prev_memory = "EMPTY"
+            if test_dial['pred_prev_summary'] == []:
+                for history in test_dial['history']:
+                    prompt_str = get_template("msc", "gpt-3.5-turbo", "gen_memory1").format_map({"prev_memory": prev_memory, "dialog": history})
+                    prev_memory = dry_summary_results(args, prompt_str)
+        elif args.mode == 'rsum':
+            dry_response_results(args, make_response_with_memory_prompt(args, test_dial))
+        else:
+            dry_response_results(args, make_response_prompt(args, test_dial))
+    print_plan(args, plan_report(args))
+
 def chat_api(args):
     test_data, test_dataset = load_dataset(args)
 
@@ -316,6 +373,10 @@ def chat_api(args):
 
     results = evaluate_corpus(all_preds, all_trues)
     result = {k: round(v * 100, 4) for k, v in results.items()}
+    if args.mode == 'rsum':
+        if args.memory_select != 'none':
+            result.update(selection_report())
+        result = compare_selection(args, result, f"{args.operation}_{args.mode}_sid{args.session_id}")
     print(result)
     with open(f'{args.logger_file}', 'a') as f:
         f.write(str(args)+"\n")
@@ -342,15 +403,17 @@ def evaluate_summary(args, test_dataset):
     labels, predictions = [],[]
     fileHandler = open(f"save_msc/memorybank/infer_full_sid4.json",  "r")
     pred_dicts = json.load(fileHandler)
-    idx = 0
-    for keys, values in tqdm(pred_dicts.items()):
-        dial_id, persona, memory = keys, values["persona"], values['memory']
+    # join the predictions with their samples by dial_id instead of by position; raises on unknown ids
+    pairs = Corpus(test_dataset).join(pred_dicts)
+    if len(pairs) < len(test_dataset):
+        print(f"evaluating the {len(pairs)} of {len(test_dataset)} samples with a prediction")
+    for sample, values in tqdm(pairs):
+        persona, memory = values["persona"], values['memory']
         result = persona + " " + memory 
-        label = test_dataset[idx]['gt_prev_summary_string'].replace("I","").replace("am","")
+        label = sample['gt_prev_summary_string'].replace("I","").replace("am","")
         #import pdb; pdb.set_trace()
         labels.append(label)
         predictions.append(result)
-        idx = idx + 1
     
     eval_matrics = evaluate_memory(predictions, labels)
     report_matrics = {k: round(v * 100, 4) for k, v in eval_matrics.items()}
@@ -369,6 +432,8 @@ if __name__ == "__main__":
         #load_eval_file(args)
     elif args.operation == 'win':
         run_llm_win(args, test_dataset)
+    elif args.dry_run:
+        plan_run(args, test_dataset)
     elif args.operation in ['infer','ict', 'rsum']:
         if 'gpt' in args.model_name:
             if args.mode == 'sum':
@@ -9,7 +9,6 @@ from openai import OpenAI
 import openai
 import httpx
 openai_modelid = 'gpt-3.5-turbo-0301' 
-prompt_path = 'memo_chat/prompts.json'
 #encoding = tiktoken.encoding_for_model(openai_modelid)
 
 q_pre = ""
@@ -26,10 +25,9 @@ TaskTarLen = {
 }
 
 from utils.env import ensure_openai_api_key
+from utils.prompts import get_prompt
 client = OpenAI(api_key=ensure_openai_api_key())
 
-prompts = json.load(open(prompt_path, "r"))
-
 def normalize_model_outputs(model_text):
     extracted_elements = [re.sub(r'\s+', ' ', mt.replace('"', '').replace("'", "")) for mt in re.findall(r"'[^']*'|\"[^\"]*\"|\d+", model_text)]
     model_outputs = []
@@ -67,8 +65,8 @@ def gen_model_output(input_qs, task_type):
     return model_outputs
 
 def run_summary(history, memo, bot_thinking):
-    system_insturction = prompts["writing_dialogsum"]["system"]
-    task_instruction = prompts["writing_dialogsum"]["instruction"]
+    system_insturction = get_prompt("memochat", "writing_dialogsum", "system")
+    task_instruction = get_prompt("memochat", "writing_dialogsum", "instruction")
     history_log = "\n\n```\nTask Conversation:\n" + "\n".join(["(line {}) {}".format(h_i + 1, h.replace("\n", " ")) for h_i, h in enumerate(history["Recent Dialogs"][2:])])
     qs = q_pre + system_insturction.replace("LINE", str(len(history["Recent Dialogs"]) - 2)) + history_log + "\n```" + task_instruction.replace("LINE", str(len(history["Recent Dialogs"]) - 2)) + qa_link
 
@@ -89,8 +87,8 @@ def run_retrieval(history, memo, bot_thinking):
     for k, v in memo.items():
         for vv in v:
             topics.append((k, vv["summary"], vv["dialogs"]))
-    system_insturction = prompts["retrieval"]["system"]
-    task_instruction = prompts["retrieval"]["instruction"]
+    system_insturction = get_prompt("memochat", "retrieval", "system")
+    task_instruction = get_prompt("memochat", "retrieval", "instruction")
     task_case = "```\nQuery Sentence:\n" + history["User Input"][6:] + "\nTopic Options:\n" + \
                 "\n".join(["({}) {}".format(v_i + 1, v[0] + ". " + v[1]) for v_i, v in enumerate(topics)]) + "\n```"
     qs = q_pre + system_insturction.replace("OPTION", str(len(topics))) + task_case + task_instruction.replace("OPTION", str(len(topics))) + qa_link
@@ -144,8 +142,9 @@ def run_memochat(args, test_dataset):
             memo = {"NOTO": [{"summary": "None of the others.", "dialogs": []}]}
         dialogue_context = []
         
-        for i in range(int(len(new_d["all_content"])/2)):
-            dialogue_context.append(new_d["all_content"][2*i] + " " + new_d["all_content"][2*i+1])
+        all_content = new_d["all_content"]
+        for i in range(int(len(all_content)/2)):
+            dialogue_context.append(all_content[2*i] + " " + all_content[2*i+1])
         bot_thinking = {"retrieval": "", "summarization": ""}
         l_i = 0
         if d['first_turn']:
@@ -162,8 +161,8 @@ def run_memochat(args, test_dataset):
             history, bot_thinking = run_retrieval(history, memo, bot_thinking)
                 
         # generate bot response
-        system_insturction = prompts["chatting"]["system"]
-        task_instruction = prompts["chatting"]["instruction"]
+        system_insturction = get_prompt("memochat", "chatting", "system")
+        task_instruction = get_prompt("memochat", "chatting", "instruction")
         task_case = "```\nRelated Evidences:\n" + "\n".join(["({}) {}".format(r_tsd_i + 1, {
                                 "Related Topics": history["Related Topics"][r_tsd_i], 
                                 "Related Summaries": history["Related Summaries"][r_tsd_i], 
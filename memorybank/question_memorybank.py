@@ -121,8 +121,9 @@ def run_memorybank(args, test_dataset, language='en'):
     for test_dial in tqdm(test_dataset):
         memory = {}
         documents = []
-        for i in range(0, len(test_dial['prev_content'])-1, 2):
-            documents.append(test_dial['prev_content'][i]+ " "+test_dial['prev_content'][i+1])
+        prev_content = test_dial['prev_content']
+        for i in range(0, len(prev_content)-1, 2):
+            documents.append(prev_content[i]+ " "+prev_content[i+1])
         retrieval_results = retrieval_content(test_dial['window'], documents, topk=5)
         hisprompt = summarize_content_prompt(retrieval_results,user_name, bot_name,language)
         his_summary = gpt_response_results(hisprompt)
@@ -0,0 +1,182 @@
+import asyncio
+import math
+import time
+from collections import deque
+
+
+class ConversationState:
+    """The live state of one user: the current dialogue window and the recursive memory."""
+    def __init__(self, conv_id, queue_size):
+        self.conv_id = conv_id
+        self.window = []
+        self.memory = "Empty"
+        self.session_id = 0
+        self.num_turns = 0
+        self.loaded = False
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.worker = None
+
+    def context(self, *turns):
+        return " ".join(self.window + list(turns))
+
+
+class RSumEngine:
+    """Serves rsum to many users at once.
+
+    Every conversation owns a bounded queue drained by its own worker task, so the turns
+    of one user are answered in order while different users run concurrently (at most
+    args.concurrency model calls in flight). When the window grows beyond
+    args.window_size words it is folded into the memory with update_summary. With a
+    MemoryStore the memory of every finished session is persisted and reloaded for
+    returning users. A conversation idle for args.idle_timeout seconds is evicted: its
+    window is folded into the memory first when there is a store, then its worker exits
+    and its state is dropped.
+    """
+    def __init__(self, args, update_summary, update_response, response_stream=None, store=None):
+        self.args = args
+        self.store = store
+        self.update_summary = update_summary
+        self.update_response = update_response
+        self.response_stream = response_stream
+        self.states = {}
+        self.semaphore = asyncio.Semaphore(args.concurrency)
+        self.latencies = deque(maxlen=10000)
+        self.evicted = 0
+
+    def get_state(self, conv_id):
+        state = self.states.get(conv_id)
+        if state is None:
+            state = ConversationState(conv_id, self.args.queue_size)
+            state.worker = asyncio.create_task(self._run(state))
+            self.states[conv_id] = state
+        return state
+
+    def submit(self, conv_id, text, sink=None):
+        """Queue a user turn and return a future with the response.
+
+        If sink is an asyncio.Queue the response pieces are pushed into it as they arrive,
+        followed by None. Raises asyncio.QueueFull when the user has too many pending turns.
+        """
+        return self._put(conv_id, "turn", text, sink)
+
+    def end_session(self, conv_id):
+        """Queue a memory update over the remaining window and return a future with the memory."""
+        return self._put(conv_id, "end", None, None)
+
+    def _put(self, conv_id, kind, text, sink):
+        state = self.get_state(conv_id)
+        future = asyncio.get_running_loop().create_future()
+        state.queue.put_nowait((kind, text, sink, future, time.perf_counter()))
+        return future
+
+    async def _run(self, state):
+        idle_timeout = getattr(self.args, "idle_timeout", 0) or None
+        while True:
+            try:
+                item = await asyncio.wait_for(state.queue.get(), idle_timeout)
+            except asyncio.TimeoutError:
+                if await self._evict(state):
+                    return
+                continue
+            kind, text, sink, future, start = item
+            try:
+                if not state.loaded:
+                    await self._load(state)
+                if kind == "turn":
+                    result = await self._answer(state, text, sink)
+                else:
+                    result = await self._fold(state)
+                if not future.cancelled():
+                    future.set_result(result)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                if sink is not None:
+                    sink.put_nowait(None)
+                if kind == "turn":
+                    self.latencies.append(time.perf_counter() - start)
+                state.queue.task_done()
+
+    async def _evict(self, state):
+        """Drop an idle conversation; False if turns arrived while its window was being saved."""
+        if self.store is not None and state.window and state.loaded:
+            try:
+                await self._fold(state)
+            except Exception:
+                # keep the conversation (and its window) rather than lose it
+                return False
+        if not state.queue.empty():
+            return False
+        # no await between the check and the removal, so no turn can be queued to a finished worker
+        del self.states[state.conv_id]
+        self.evicted += 1
+        return True
+
+    async def _load(self, state):
+        """Restore the latest memory of a returning user, off the event loop."""
+        if self.store is not None:
+            session_id, memory = await asyncio.to_thread(self.store.get_latest, state.conv_id)
+            if session_id is not None:
+                state.session_id, state.memory = session_id, memory
+        state.loaded = True
+
+    async def _answer(self, state, text, sink):
+        # the turns join the window only once the model has answered, so a failed call leaves it as it was
+        user_turn = f"User: {text}"
+        context = state.context(user_turn)
+        async with self.semaphore:
+            if sink is None or self.response_stream is None:
+                response = await asyncio.to_thread(self.update_response, self.args, summary=state.memory, context=context)
+                if sink is not None:
+                    sink.put_nowait(response)
+            else:
+                response = await asyncio.to_thread(self._pump, state.memory, context, sink, asyncio.get_running_loop())
+        # the same speaker labels as the dialogue windows of chatgpt/data_loader.py
+        state.window += [user_turn, f"System: {response}"]
+        state.num_turns += 1
+        if len(state.context().split(" ")) > self.args.window_size:
+            await self._fold(state)
+        return response
+
+    def _pump(self, memory, context, sink, loop):
+        pieces = []
+        for piece in self.response_stream(self.args, summary=memory, context=context):
+            pieces.append(piece)
+            loop.call_soon_threadsafe(sink.put_nowait, piece)
+        return "".join(pieces).replace("\n", "").replace("System:", "")
+
+    async def _fold(self, state):
+        if state.window:
+            async with self.semaphore:
+                state.memory = await asyncio.to_thread(self.update_summary, self.args, context=state.context(), summary=state.memory)
+            state.window = []
+            state.session_id += 1
+            if self.store is not None:
+                self.store.put(state.conv_id, state.session_id, state.memory)
+        return state.memory
+
+    def metrics(self):
+        latencies = sorted(self.latencies)
+        return {
+            "conversations": len(self.states),
+            "evicted": self.evicted,
+            "pending": sum(state.queue.qsize() for state in self.states.values()),
+            "requests": len(latencies),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        }
+
+    async def close(self):
+        for state in self.states.values():
+            state.worker.cancel()
+        await asyncio.gather(*[state.worker for state in self.states.values()], return_exceptions=True)
+        if self.store is not None:
+            self.store.close()
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(p / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[rank]
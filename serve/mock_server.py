@@ -0,0 +1,69 @@
+"""A local stand-in for the OpenAI chat completions API.
+
+    python serve/mock_server.py --port 8001 --delay 0.2
+    OPENAI_API_KEY=mock OPENAI_BASE_URL=http://127.0.0.1:8001/v1 python serve/server.py
+
+Responses are deterministic, so the serving engine can be load tested without cost.
+"""
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def mock_completion(messages):
+    prompt = messages[-1]["content"] if messages else ""
+    if "[Updated Memory]" in prompt:
+        context = prompt.split("[Dialogue Context]")[-1].split("[Updated Memory]")[0].strip()
+        return "User: " + " ".join(context.split(" ")[:30])
+    return f"Mock response to a prompt of {len(prompt.split(' '))} words."
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    delay = 0.0
+
+    def do_POST(self):
+        if not self.path.endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        content = mock_completion(request.get("messages", []))
+        time.sleep(self.delay)
+        created = int(time.time())
+        model = request.get("model", "mock")
+        if request.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for piece in [word + " " for word in content.split(" ")]:
+                chunk = {"id": "mock", "object": "chat.completion.chunk", "created": created, "model": model,
+                         "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+            return
+        body = json.dumps({
+            "id": "mock", "object": "chat.completion", "created": created, "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds to wait before answering")
+    mock_args = parser.parse_args()
+    MockHandler.delay = mock_args.delay
+    server = ThreadingHTTPServer((mock_args.host, mock_args.port), MockHandler)
+    print(f"Mock completion server listening on http://{mock_args.host}:{mock_args.port}/v1")
+    server.serve_forever()
@@ -0,0 +1,137 @@
+"""asyncio HTTP front end for RSumEngine.
+
+    POST /chat          {"conv_id": ..., "text": ...}  -> {"response": ...}
+    POST /chat/stream   {"conv_id": ..., "text": ...}  -> chunked text/plain
+    POST /end           {"conv_id": ...}               -> {"memory": ...}
+    GET  /metrics                                      -> request count and p50/p99 latency
+
+Point OPENAI_BASE_URL at serve/mock_server.py to run without the real API, and pass
+--memory_db to keep the memories of finished sessions across restarts.
+"""
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import get_args
+from serve.engine import RSumEngine
+from utils.memory_store import MemoryStore
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error"}
+
+
+async def read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, value = line.decode("latin-1").split(":", 1)
+        headers[key.strip().lower()] = value.strip()
+    body = b""
+    if int(headers.get("content-length", 0)) > 0:
+        body = await reader.readexactly(int(headers["content-length"]))
+    return method, path.split("?")[0], body
+
+
+async def write_json(writer, status, payload):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+    await writer.drain()
+
+
+async def write_stream(writer, sink, future):
+    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; charset=utf-8\r\n"
+                 b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+    while True:
+        piece = await sink.get()
+        if piece is None:
+            break
+        data = piece.encode("utf-8")
+        writer.write(f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n")
+        await writer.drain()
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+    # surfaces errors from the worker in the server log
+    await future
+
+
+def make_handler(engine):
+    async def handle(reader, writer):
+        try:
+            request = await read_request(reader)
+            if request is None:
+                return
+            method, path, body = request
+            if method == "GET" and path == "/metrics":
+                await write_json(writer, 200, engine.metrics())
+                return
+            if method != "POST" or path not in ["/chat", "/chat/stream", "/end"]:
+                await write_json(writer, 404, {"error": f"unknown route {method} {path}"})
+                return
+            try:
+                payload = json.loads(body or b"{}")
+                conv_id = str(payload["conv_id"])
+                text = payload.get("text", "")
+            except (ValueError, KeyError):
+                await write_json(writer, 400, {"error": "expected a JSON body with conv_id and text"})
+                return
+            try:
+                if path == "/end":
+                    future = engine.end_session(conv_id)
+                elif path == "/chat/stream":
+                    sink = asyncio.Queue()
+                    future = engine.submit(conv_id, text, sink)
+                else:
+                    future = engine.submit(conv_id, text)
+            except asyncio.QueueFull:
+                await write_json(writer, 429, {"error": f"too many pending turns for {conv_id}"})
+                return
+            if path == "/end":
+                await write_json(writer, 200, {"conv_id": conv_id, "memory": await future})
+            elif path == "/chat/stream":
+                await write_stream(writer, sink, future)
+            else:
+                await write_json(writer, 200, {"conv_id": conv_id, "response": await future})
+        except Exception as e:
+            try:
+                await write_json(writer, 500, {"error": str(e)})
+            except Exception:
+                pass
+        finally:
+            writer.close()
+    return handle
+
+
+def build_engine(args):
+    from main_chatgpt import update_summary, update_response, make_response_prompt
+    from chatgpt.robot import gpt_response_stream
+
+    def response_stream(args, summary="", context=""):
+        return gpt_response_stream(args, make_response_prompt(args, summary=summary, context=context))
+
+    store = MemoryStore(args.memory_db) if args.memory_db else None
+    return RSumEngine(args, update_summary, update_response, response_stream, store)
+
+
+async def serve(args):
+    engine = build_engine(args)
+    server = await asyncio.start_server(make_handler(engine), args.host, args.port)
+    print(f"RSum server listening on http://{args.host}:{args.port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await engine.close()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    asyncio.run(serve(args))
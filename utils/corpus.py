@@ -0,0 +1,41 @@
+"""Samples indexed by dial_id (and session).
+
+Prediction files are dicts keyed by dial_id, so joining them with the test samples is a
+dict lookup per sample instead of matching by list position or scanning a list.
+"""
+
+
+class Corpus:
+    def __init__(self, samples=(), session_id=None):
+        self.samples = []
+        self.by_id = {}
+        for sample in samples:
+            self.add(sample, session_id)
+
+    def add(self, sample, session_id=None):
+        self.by_id[(session_id, sample["dial_id"])] = len(self.samples)
+        self.samples.append(sample)
+
+    def join(self, predictions, session_id=None):
+        """The (sample, prediction) pairs of a prediction dict, in its order.
+
+        Raises ValueError if some dial_ids of the predictions are not in the corpus, so metrics
+        are never computed over a silent subset.
+        """
+        pairs, unmatched = [], []
+        for dial_id, prediction in predictions.items():
+            index = self.by_id.get((session_id, dial_id))
+            if index is None:
+                unmatched.append(dial_id)
+            else:
+                pairs.append((self.samples[index], prediction))
+        if unmatched:
+            raise ValueError(f"{len(unmatched)} of {len(predictions)} predictions have no sample in the corpus, "
+                             f"e.g. {unmatched[:5]}")
+        return pairs
+
+    def __iter__(self):
+        return iter(self.samples)
+
+    def __len__(self):
+        return len(self.samples)
@@ -0,0 +1,84 @@
+"""On-disk cache of parsed corpora.
+
+The MSC / CareCall loaders re-parse the raw files, rebuild the joined context strings and
+re-merge the personas on every run. Decorated loaders store their result as one pickle under
+--data_cache, keyed by the content hash of the source files, the loader version, the
+arguments the loader reads and its other parameters; a later run with the same key unpickles the
+file instead of parsing. Bump the version of a loader whenever its output changes. A cache that no
+longer unpickles (e.g. a class of utils/turns.py was renamed) is parsed and written again.
+"""
+import functools
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+_digests = {}
+
+
+def file_digest(path):
+    if not os.path.exists(path):
+        return "missing"
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key not in _digests:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            for block in iter(functools.partial(f.read, 1 << 20), b""):
+                digest.update(block)
+        _digests[key] = digest.hexdigest()
+    return _digests[key]
+
+
+def cache_path(args, name, version, paths, arg_names, params=()):
+    key = {
+        "loader": name,
+        "version": version,
+        "sources": [[path, file_digest(path)] for path in paths],
+        "args": {arg: getattr(args, arg, None) for arg in arg_names},
+        "params": [repr(param) for param in params],
+    }
+    digest = hashlib.blake2b(json.dumps(key, sort_keys=True).encode("utf-8"), digest_size=16).hexdigest()
+    return os.path.join(args.data_cache, f"{name}-{digest}.pkl")
+
+
+def load_pickle(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def dump_pickle(obj, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temporary file first so concurrent runs never read a partial cache
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+def corpus_cache(name, version, sources, arg_names=()):
+    """Cache loader(args, *params); sources(args, *params) lists the files the loader reads."""
+    def decorator(loader):
+        def cache_file(args, *params):
+            if not getattr(args, "data_cache", ""):
+                return None
+            return cache_path(args, name, version, sources(args, *params), arg_names, params)
+
+        @functools.wraps(loader)
+        def wrapper(args, *params):
+            path = cache_file(args, *params)
+            if path is None:
+                return loader(args, *params)
+            if os.path.exists(path):
+                try:
+                    return load_pickle(path)
+                except (pickle.UnpicklingError, EOFError, ValueError, AttributeError, ImportError):
+                    pass
+            data = loader(args, *params)
+            dump_pickle(data, path)
+            return data
+        wrapper.cache_file = cache_file
+        return wrapper
+    return decorator
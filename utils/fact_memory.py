@@ -0,0 +1,100 @@
+import re
+from utils.persona_merge import persona_f1
+
+SPEAKERS = ["User", "Assistant"]
+re_speaker = re.compile(r'\b(User|Assistant|System)\s*:')
+re_sentence = re.compile(r'(?<=[.!?])\s+')
+
+
+class FactMemory:
+    """Structured recursive memory: a list of persona facts with ids for each speaker.
+
+    Speaker 0 is the user and speaker 1 the assistant, the same layout as gt_prev_summary.
+    New facts are merged into a near-duplicate (token F1 above threshold) the way
+    merge_personas does it, otherwise appended, so an update only touches the facts it
+    changes. str() renders the memory like get_person_string, so it can be passed to the
+    prompts wherever the free-text summary went.
+    """
+    def __init__(self, threshold=0.4):
+        self.threshold = threshold
+        self.facts = [[], []]
+        self.next_id = 0
+
+    @classmethod
+    def from_personas(cls, personas, threshold=0.4):
+        memory = cls(threshold)
+        for speaker in range(2):
+            for persona in personas[speaker]:
+                memory.add(speaker, persona)
+        return memory
+
+    @classmethod
+    def from_text(cls, text, threshold=0.4):
+        """Split a free-text memory ("User: ... Assistant: ...") into facts."""
+        memory = cls(threshold)
+        memory.update(parse_facts(text))
+        return memory
+
+    @classmethod
+    def from_dict(cls, data):
+        memory = cls(data.get("threshold", 0.4))
+        memory.facts = [[dict(fact) for fact in facts] for facts in data["facts"]]
+        memory.next_id = data["next_id"]
+        return memory
+
+    def to_dict(self):
+        facts = [[dict(fact) for fact in facts] for facts in self.facts]
+        return {"threshold": self.threshold, "facts": facts, "next_id": self.next_id}
+
+    def add(self, speaker, text):
+        """Merge text into a similar fact or append it. Returns the id of the touched fact."""
+        text = text.strip()
+        for fact in self.facts[speaker]:
+            if persona_f1(text, fact["text"], self.threshold) > self.threshold:
+                if text not in fact["text"]:
+                    fact["text"] = ' '.join([fact["text"], text])
+                return fact["id"]
+        fact = {"id": self.next_id, "text": text}
+        self.next_id += 1
+        self.facts[speaker].append(fact)
+        return fact["id"]
+
+    def update(self, add_personas):
+        """Add new facts given as [user_facts, assistant_facts]. Returns the touched fact ids."""
+        touched = []
+        for speaker in range(2):
+            for text in add_personas[speaker]:
+                if text.strip():
+                    touched.append(self.add(speaker, text))
+        return touched
+
+    def to_personas(self, fact_ids=None):
+        return [[fact["text"] for fact in facts if fact_ids is None or fact["id"] in fact_ids]
+                for facts in self.facts]
+
+    def to_string(self, fact_ids=None):
+        """Render all facts, or only those in fact_ids, as "User: ... Assistant: ..."."""
+        personas = self.to_personas(fact_ids)
+        return "User: " + " ".join(personas[0]) + " Assistant: " + " ".join(personas[1])
+
+    def __len__(self):
+        return len(self.facts[0]) + len(self.facts[1])
+
+    def __str__(self):
+        if len(self) == 0:
+            return "Empty"
+        return self.to_string()
+
+
+def parse_facts(text):
+    """Parse "User: ... Assistant: ..." text (one or many sections) into [user_facts, assistant_facts]."""
+    add_personas = [[], []]
+    parts = re_speaker.split(text)
+    # parts = [prefix, speaker, body, speaker, body, ...]; text before the first speaker tag is dropped
+    for speaker, body in zip(parts[1::2], parts[2::2]):
+        idx = 0 if speaker == "User" else 1
+        for sentence in re_sentence.split(body.strip()):
+            sentence = sentence.strip(" -;\n")
+            if sentence and sentence.lower() not in ["none", "none.", "empty", "empty."]:
+                add_personas[idx].append(sentence)
+    return add_personas
@@ -0,0 +1,24 @@
+"""Streaming JSONL reading, with orjson when it is installed."""
+import json
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+
+def read_jsonl(path, limit=None):
+    """Yield the records of a JSONL file, stopping after limit records if it is given."""
+    if limit is not None and limit <= 0:
+        return
+    count = 0
+    with open(path, "rb") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            yield loads(line)
+            count += 1
+            if limit is not None and count >= limit:
+                return
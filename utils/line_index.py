@@ -0,0 +1,109 @@
+"""Byte offsets of the records of a JSONL corpus file, so a reader can seek to its part.
+
+    index = line_index(args, "data/msc/msc/msc_personasummary/session_1/train.txt")
+    for record in index.read_shard(rank, world_size): ...
+    record = index.get("train_1234")                     # by initial_data_id
+
+The index keeps the start and end byte of every non-empty line and the initial_data_id of
+its record (top-level or under "metadata"). It is built with one pass over the file and saved
+as an .npz under --data_cache, keyed like the corpus cache by the content hash of the file.
+"""
+import os
+import tempfile
+
+import numpy as np
+
+from utils.corpus_cache import cache_path
+from utils.jsonl import loads
+
+INDEX_VERSION = 1
+
+_indexes = {}
+
+
+def record_id(record):
+    if "initial_data_id" in record:
+        return str(record["initial_data_id"])
+    return str(record.get("metadata", {}).get("initial_data_id", ""))
+
+
+class LineIndex:
+    def __init__(self, path, starts, ends, ids):
+        self.path = path
+        self.starts = starts
+        self.ends = ends
+        self.ids = ids
+        self.positions = {record_id: position for position, record_id in enumerate(ids.tolist())}
+
+    @classmethod
+    def build(cls, path):
+        starts, ends, ids = [], [], []
+        offset = 0
+        with open(path, "rb") as f:
+            for line in f:
+                stripped = line.strip()
+                if stripped:
+                    starts.append(offset)
+                    ends.append(offset + len(line))
+                    ids.append(record_id(loads(stripped)))
+                offset += len(line)
+        return cls(path, np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64), np.asarray(ids, dtype=str))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def shard_bounds(self, index, count):
+        """The records [start, stop) of shard index out of count contiguous shards."""
+        return len(self) * index // count, len(self) * (index + 1) // count
+
+    def read(self, start=0, stop=None):
+        """Yield the records [start, stop), reading only their bytes."""
+        stop = len(self) if stop is None else min(stop, len(self))
+        if start >= stop:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(int(self.starts[start]))
+            position = start
+            while position < stop:
+                line = f.readline().strip()
+                if line:
+                    yield loads(line)
+                    position += 1
+
+    def read_shard(self, index, count):
+        return self.read(*self.shard_bounds(index, count))
+
+    def record(self, position):
+        with open(self.path, "rb") as f:
+            f.seek(int(self.starts[position]))
+            return loads(f.read(int(self.ends[position] - self.starts[position])).strip())
+
+    def get(self, initial_data_id):
+        return self.record(self.positions[initial_data_id])
+
+
+def save_index(index, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        np.savez(f, starts=index.starts, ends=index.ends, ids=index.ids)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+def line_index(args, path):
+    """The LineIndex of a JSONL file, loaded from --data_cache or built (and saved there)."""
+    index_file = None
+    if getattr(args, "data_cache", ""):
+        index_file = os.path.splitext(cache_path(args, "line_index", INDEX_VERSION, [path], ()))[0] + ".npz"
+    key = (path, index_file)
+    if key not in _indexes:
+        if index_file is not None and os.path.exists(index_file):
+            with np.load(index_file) as arrays:
+                index = LineIndex(path, arrays["starts"], arrays["ends"], arrays["ids"])
+        else:
+            index = LineIndex.build(path)
+            if index_file is not None:
+                save_index(index, index_file)
+        _indexes[key] = index
+    return _indexes[key]
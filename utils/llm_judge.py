@@ -7,9 +7,8 @@ from tqdm import tqdm
 import random
 random.seed(42)
 
-prompts = json.load(open("data/msc/msc/msc_dialogue/prompts.json", "r"))
-
 from utils.env import ensure_openai_api_key
+from utils.prompts import get_prompt, get_template
 client = OpenAI(api_key=ensure_openai_api_key())
 def gpt_response_results(prompt, model_name):
     for _ in range(100):
@@ -62,7 +61,7 @@ def run_llm_win(args, test_dataset):
         d = test_dataset[idx]
         dial_id = d['dial_id']
         response1, response2 = r1[dial_id]['prediction'], r2[dial_id]['prediction']
-        input_str = prompts['gpt-4']['win_rate'].format_map(
+        input_str = get_template("msc", "gpt-4", "win_rate").format_map(
             {'dialog':" ".join(d['all_content'][-10:]), 'persona': d['gt_prev_summary_string'], 'response1': response1, 'response2': response2})
         judge_result = gpt_response_results(input_str, 'gpt-3.5-turbo-1106')
         output.append({
@@ -99,8 +98,8 @@ def run_llm_judge(args, test_dataset):
         dial_id = d['dial_id']
         response = result_data[dial_id]['prediction']
         for c in conditions.keys():
-            condition_str = prompts['gpt-4'][c]
-            judge_prompt = prompts['gpt-4']['single_eval'].format_map(
+            condition_str = get_prompt("msc", "gpt-4", c)
+            judge_prompt = get_template("msc", "gpt-4", "single_eval").format_map(
                 {'dialog':" ".join(d['all_content'][-10:]), 'persona': d['gt_prev_summary_string'], 'response': response,'condition':condition_str})
             outputs = gpt_response_results(judge_prompt, 'gpt-4-0314')
             match = re.search(r'\[\[(\d+)\]\]', outputs)
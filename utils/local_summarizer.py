@@ -0,0 +1,33 @@
+import threading
+
+_model, _tokenizer = None, None
+_lock = threading.Lock()
+
+
+def load_local_summarizer(args):
+    """Load the LoRA summarizer saved by distill.py (the adapter directory in --load_path)."""
+    global _model, _tokenizer
+    if _model is None:
+        import torch
+        from peft import AutoPeftModelForCausalLM
+        from transformers import AutoTokenizer
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        _tokenizer = AutoTokenizer.from_pretrained(args.load_path)
+        _model = AutoPeftModelForCausalLM.from_pretrained(args.load_path).to(device)
+        _model.eval()
+    return _model, _tokenizer
+
+
+def local_summary_results(args, prompt):
+    """Drop-in replacement of gpt_summary_results backed by the distilled summarizer."""
+    import torch
+    with _lock:
+        model, tokenizer = load_local_summarizer(args)
+        inputs = tokenizer(prompt, return_tensors="pt", add_special_tokens=False).to(model.device)
+        with torch.inference_mode():
+            output = model.generate(**inputs, max_new_tokens=args.summary_size, do_sample=False,
+                                    pad_token_id=tokenizer.pad_token_id)
+    line_m = tokenizer.decode(output[0][inputs["input_ids"].shape[1]:], skip_special_tokens=True).strip()
+    if '[Updated Memory]' in line_m:
+        line_m = line_m.split("[Updated Memory]")[-1]
+    return line_m
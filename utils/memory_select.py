@@ -0,0 +1,152 @@
+import json
+import math
+import os
+import threading
+from collections import Counter
+from functools import lru_cache
+from utils.evaluation import normalize_answer
+from utils.fact_memory import FactMemory, parse_facts, SPEAKERS
+
+# running totals of memory tokens before and after selection, reported next to F1/BLEU
+SELECT_STATS = {"calls": 0, "full_tokens": 0, "selected_tokens": 0}
+stats_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def get_encoding():
+    import tiktoken
+    return tiktoken.get_encoding("cl100k_base")
+
+
+@lru_cache(maxsize=100000)
+def count_tokens(text):
+    return len(get_encoding().encode(text))
+
+
+@lru_cache(maxsize=2)
+def get_dense_model(model_name):
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name, device="cpu")
+
+
+@lru_cache(maxsize=100000)
+def embed_sentence(model_name, sentence):
+    return get_dense_model(model_name).encode(sentence, normalize_embeddings=True)
+
+
+def split_memory(memory):
+    """Return the memory as a list of (speaker, sentence) in their original order.
+
+    The speaker is 0 (user), 1 (assistant) or None for memories without speaker tags.
+    """
+    if isinstance(memory, FactMemory):
+        personas = memory.to_personas()
+    else:
+        if isinstance(memory, list):
+            memory = " ".join(str(m) for m in memory)
+        personas = parse_facts(memory)
+        if personas == [[], []] and memory.strip():
+            # memories without speaker tags are split into sentences the same way and stay untagged
+            return [(None, sentence) for sentence in parse_facts("User: " + memory)[0]]
+    return [(speaker, sentence) for speaker in range(2) for sentence in personas[speaker]]
+
+
+def bm25_scores(query, sentences, k1=1.5, b=0.75):
+    docs = [normalize_answer(sentence).split() for sentence in sentences]
+    avgdl = sum(len(doc) for doc in docs) / max(len(docs), 1)
+    df = Counter(token for doc in docs for token in set(doc))
+    query_tokens = normalize_answer(query).split()
+    scores = []
+    for doc in docs:
+        tf = Counter(doc)
+        score = 0.0
+        for token in query_tokens:
+            if token not in tf:
+                continue
+            idf = math.log(1 + (len(docs) - df[token] + 0.5) / (df[token] + 0.5))
+            score += idf * tf[token] * (k1 + 1) / (tf[token] + k1 * (1 - b + b * len(doc) / max(avgdl, 1)))
+        scores.append(score)
+    return scores
+
+
+def dense_scores(query, sentences, model_name):
+    query_emb = embed_sentence(model_name, query)
+    return [float(query_emb @ embed_sentence(model_name, sentence)) for sentence in sentences]
+
+
+def render(selected):
+    """Untagged sentences as plain text, then one section per speaker that has sentences."""
+    parts = [" ".join(sentence for speaker, sentence in selected if speaker is None)]
+    for idx, name in enumerate(SPEAKERS):
+        sentences = [sentence for speaker, sentence in selected if speaker == idx]
+        if sentences:
+            parts.append(f"{name}: " + " ".join(sentences))
+    return " ".join(part for part in parts if part)
+
+
+def select_memory(args, memory, window):
+    """Keep only the memory sentences most relevant to the window.
+
+    Sentences are scored against the window with BM25 (args.memory_select == 'bm25') or a
+    cached CPU sentence embedding model ('dense'); the best args.memory_topk are kept while
+    they fit in args.memory_budget tokens and rendered in their original order. With
+    'none' the memory is returned unchanged.
+    """
+    if args.memory_select == "none":
+        return memory
+    if isinstance(window, list):
+        window = " ".join(window)
+    sentences = split_memory(memory)
+    if not sentences:
+        return str(memory)
+    texts = [sentence for _, sentence in sentences]
+    if args.memory_select == "dense":
+        scores = dense_scores(window, texts, args.select_model)
+    else:
+        scores = bm25_scores(window, texts)
+
+    ranked = sorted(range(len(sentences)), key=lambda i: scores[i], reverse=True)
+    keep, used = [], 0
+    for i in ranked[:args.memory_topk]:
+        tokens = count_tokens(texts[i])
+        if args.memory_budget > 0 and used + tokens > args.memory_budget:
+            continue
+        keep.append(i)
+        used += tokens
+    selected = render([sentences[i] for i in sorted(keep)])
+
+    full_tokens, selected_tokens = count_tokens(str(memory)), count_tokens(selected)
+    with stats_lock:
+        SELECT_STATS["calls"] += 1
+        SELECT_STATS["full_tokens"] += full_tokens
+        SELECT_STATS["selected_tokens"] += selected_tokens
+    return selected
+
+
+def selection_report():
+    calls = max(SELECT_STATS["calls"], 1)
+    full, selected = SELECT_STATS["full_tokens"], SELECT_STATS["selected_tokens"]
+    return {
+        "select_calls": SELECT_STATS["calls"],
+        "ave_memory_tokens": round(full / calls, 2),
+        "ave_selected_tokens": round(selected / calls, 2),
+        "token_saving": round(1 - selected / full, 4) if full else 0.0,
+    }
+
+
+def compare_selection(args, result, name):
+    """Save the metrics of a run as <name>_select_<memory_select>.json in args.saving_dir and,
+    for bm25/dense, add the metrics of the matching --memory_select none run and the change
+    against them (none_<metric> and delta_<metric>) when that run has been saved."""
+    with open(os.path.join(args.saving_dir, f"{name}_select_{args.memory_select}.json"), "w") as f:
+        json.dump(result, f, indent=4)
+    baseline_file = os.path.join(args.saving_dir, f"{name}_select_none.json")
+    if args.memory_select == "none" or not os.path.exists(baseline_file):
+        return result
+    with open(baseline_file, "r") as f:
+        baseline = json.load(f)
+    for metric, value in baseline.items():
+        if metric in result and isinstance(value, (int, float)):
+            result[f"none_{metric}"] = value
+            result[f"delta_{metric}"] = round(result[metric] - value, 4)
+    return result
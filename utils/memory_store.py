@@ -0,0 +1,161 @@
+import json
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+_STOP = object()
+
+
+class MemoryStore:
+    """Recursive memories of many conversations in one SQLite database.
+
+    Rows are keyed by (conv_id, session_id), so a read or an update touches a single
+    primary-key row no matter how many conversations are stored. The database runs in
+    WAL mode; recently used memories are kept in an in-RAM LRU cache and writes go
+    through a background thread which commits them in batches (write-behind). Values
+    are anything json can encode, e.g. a text memory or FactMemory.to_dict().
+    """
+    def __init__(self, path, cache_size=4096, batch_size=256, flush_interval=0.5):
+        self.path = path
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.cache = OrderedDict()
+        # key -> (seq, memory) for writes that are queued but not committed yet
+        self.pending = {}
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.read_conn = self._connect()
+        self.read_conn.execute(
+            "CREATE TABLE IF NOT EXISTS memories ("
+            "conv_id TEXT NOT NULL, session_id INTEGER NOT NULL, memory TEXT NOT NULL, updated REAL NOT NULL, "
+            "PRIMARY KEY (conv_id, session_id)) WITHOUT ROWID")
+        self.read_conn.commit()
+        self.writes = queue.Queue()
+        # the exception that stopped the writer thread, re-raised by flush()
+        self.error = None
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _remember(self, key, value):
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def get(self, conv_id, session_id, default=None):
+        key = (conv_id, session_id)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            if key in self.pending:
+                return self.pending[key][1]
+            row = self.read_conn.execute(
+                "SELECT memory FROM memories WHERE conv_id = ? AND session_id = ?", key).fetchone()
+            if row is None:
+                return default
+            value = json.loads(row[0])
+            self._remember(key, value)
+            return value
+
+    def get_latest(self, conv_id):
+        """Return (session_id, memory) of the latest session of conv_id, or (None, None)."""
+        with self.lock:
+            pending = [key[1] for key in self.pending if key[0] == conv_id]
+            row = self.read_conn.execute(
+                "SELECT MAX(session_id) FROM memories WHERE conv_id = ?", (conv_id,)).fetchone()
+        sessions = pending + ([row[0]] if row[0] is not None else [])
+        if not sessions:
+            return None, None
+        return max(sessions), self.get(conv_id, max(sessions))
+
+    def put(self, conv_id, session_id, memory):
+        key = (conv_id, session_id)
+        with self.lock:
+            self.seq += 1
+            self._remember(key, memory)
+            self.pending[key] = (self.seq, memory)
+            self.writes.put((key, self.seq, json.dumps(memory, ensure_ascii=False)))
+
+    def _write_loop(self):
+        conn = self._connect()
+        stop = False
+        while not stop:
+            batch = [self.writes.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.writes.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            flushed = [item for item in batch if isinstance(item, threading.Event)]
+            stop = any(item is _STOP for item in batch)
+            rows = {}
+            for item in batch:
+                if isinstance(item, tuple):
+                    rows[item[0]] = item[1:]
+            try:
+                if rows and self.error is None:
+                    now = time.time()
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO memories (conv_id, session_id, memory, updated) VALUES (?, ?, ?, ?)",
+                        [(key[0], key[1], memory, now) for key, (_, memory) in rows.items()])
+                    conn.commit()
+                    with self.lock:
+                        for key, (seq, _) in rows.items():
+                            if key in self.pending and self.pending[key][0] == seq:
+                                del self.pending[key]
+            except Exception as e:
+                # keep draining the queue so that flush() and close() never wait forever
+                self.error = e
+            finally:
+                for event in flushed:
+                    event.set()
+        conn.close()
+
+    def flush(self):
+        """Block until every write queued so far is committed."""
+        event = threading.Event()
+        self.writes.put(event)
+        event.wait()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.writes.put(_STOP)
+            self.writer.join()
+            self.read_conn.close()
+
+    def session(self, session_id):
+        return SessionView(self, session_id)
+
+
+class SessionView:
+    """Dict-like view of the memories of one session: `dial_id in view` and `view[dial_id]`."""
+    def __init__(self, store, session_id):
+        self.store = store
+        self.session_id = session_id
+
+    def __contains__(self, conv_id):
+        return self.store.get(conv_id, self.session_id) is not None
+
+    def __getitem__(self, conv_id):
+        memory = self.store.get(conv_id, self.session_id)
+        if memory is None:
+            raise KeyError(conv_id)
+        return memory
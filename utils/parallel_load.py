@@ -0,0 +1,53 @@
+"""Parse several corpus files at once on a process pool.
+
+    data_train, data_dev, data_test = load_parallel(args, [(read_msc_data, path_train),
+                                                           (read_msc_data, path_dev),
+                                                           (read_msc_data, path_test)])
+
+Every job is (loader, *params) and is run as loader(args, *params) in a worker process;
+the results come back in job order whatever order the workers finish in. Loaders wrapped
+by corpus_cache write their result to the cache in the worker and the parent reads the
+cache file, so the parsed corpus is not pickled through the pool a second time.
+"""
+import argparse
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.corpus_cache import load_pickle
+
+
+def picklable_args(args):
+    """Copy of args without the attributes a worker process cannot receive (loggers, stores)."""
+    values = {}
+    for key, value in vars(args).items():
+        try:
+            pickle.dumps(value)
+        except Exception:
+            continue
+        values[key] = value
+    return argparse.Namespace(**values)
+
+
+def run_job(args, loader, params):
+    data = loader(args, *params)
+    cache_file = getattr(loader, "cache_file", None)
+    path = cache_file(args, *params) if cache_file is not None else None
+    if path is not None and os.path.exists(path):
+        return "cache", path
+    return "data", data
+
+
+def load_parallel(args, jobs, num_workers=None):
+    num_workers = num_workers or getattr(args, "load_workers", 0) or os.cpu_count() or 1
+    num_workers = min(num_workers, len(jobs))
+    if num_workers <= 1:
+        return [loader(args, *params) for loader, *params in jobs]
+    worker_args = picklable_args(args)
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        futures = [pool.submit(run_job, worker_args, loader, params) for loader, *params in jobs]
+        results = []
+        for future in futures:
+            kind, payload = future.result()
+            results.append(load_pickle(payload) if kind == "cache" else payload)
+    return results
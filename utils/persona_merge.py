@@ -0,0 +1,109 @@
+"""Persona merging shared by the loaders and FactMemory.
+
+A new persona sentence is appended to the first existing persona of the same speaker whose
+token F1 (compute_f1_sentence) is above the threshold, otherwise it is added as a new
+persona. The normalized token multiset of every sentence is computed once and cached, and
+pairs whose lengths alone keep the F1 under the threshold are skipped before counting.
+"""
+from collections import Counter, deque
+from functools import lru_cache
+
+from utils.evaluation import normalize_answer
+
+
+@lru_cache(maxsize=1 << 17)
+def persona_tokens(text):
+    tokens = normalize_answer(text).split()
+    return Counter(tokens), len(tokens)
+
+
+def persona_f1(pred, label, threshold=0.0):
+    """compute_f1_sentence(pred, label), or 0 once the lengths rule out an F1 above threshold."""
+    pred_counts, num_pred = persona_tokens(pred)
+    gold_counts, num_gold = persona_tokens(label)
+    if num_pred == 0 or num_gold == 0:
+        return 0
+    # F1 = 2 * num_same / (num_pred + num_gold) and num_same <= min(num_pred, num_gold);
+    # ties are left to the exact computation below
+    if 2 * min(num_pred, num_gold) < threshold * (num_pred + num_gold) - 1e-9:
+        return 0
+    if len(pred_counts) > len(gold_counts):
+        pred_counts, gold_counts = gold_counts, pred_counts
+    num_same = sum(min(count, gold_counts[token]) for token, count in pred_counts.items() if token in gold_counts)
+    if num_same == 0:
+        return 0
+    precision = 1.0 * num_same / num_pred
+    recall = 1.0 * num_same / num_gold
+    return (2 * precision * recall) / (precision + recall)
+
+
+def find_similar(text, personas, threshold):
+    """Index of the first persona with F1 above threshold, or -1."""
+    for j, persona in enumerate(personas):
+        if persona_f1(text, persona, threshold) > threshold:
+            return j
+    return -1
+
+
+def merge_personas(init_personas, add_personas, threshold=0.4):
+    if add_personas[0] == [] and add_personas[1] == []:
+        return init_personas
+
+    new_personas = []
+    for i in range(2):
+        personas_i = init_personas[i].copy()
+        for ip in add_personas[i]:
+            j = find_similar(ip, personas_i, threshold)
+            if j >= 0:
+                personas_i[j] = ' '.join([personas_i[j], ip])
+            else:
+                personas_i.append(ip)
+        new_personas.append(personas_i)
+    return new_personas
+
+
+class PersonaState:
+    """merge_personas of one speaker's initial personas with a growing persona list.
+
+    The persona lists of an episode (agg_persona_list) only grow, and merging is sequential,
+    so extending the list only merges the new sentences into the current state.
+    """
+    def __init__(self, init_personas, threshold):
+        self.init_personas = init_personas
+        self.threshold = threshold
+        self.added = []
+        self.personas = init_personas.copy()
+
+    def update(self, add_personas):
+        if add_personas[:len(self.added)] != self.added:
+            self.added, self.personas = [], self.init_personas.copy()
+        for ip in add_personas[len(self.added):]:
+            j = find_similar(ip, self.personas, self.threshold)
+            if j >= 0:
+                self.personas[j] = ' '.join([self.personas[j], ip])
+            else:
+                self.personas.append(ip)
+        self.added = list(add_personas)
+        return self.personas
+
+
+def summary_windows(episode, init_personas, num_turns, threshold):
+    """Yield (end_idx, window utterances, personas) for every turn of a persona-summary episode.
+
+    The personas are merge_personas(init_personas, [agg_persona_list of the last two turns]) and
+    the window holds the last num_turns utterances (all of them if num_turns <= 0).
+    """
+    window = deque(maxlen=num_turns if num_turns > 0 else None)
+    states = [PersonaState(init_personas[0], threshold), PersonaState(init_personas[1], threshold)]
+    for end_idx, turn in enumerate(episode):
+        prefix = "partner: " if end_idx % 2 == 0 else "you: "
+        window.append(f'{prefix}{turn["text"]}')
+        add_personas = [[], []]
+        add_personas[end_idx % 2] = turn['agg_persona_list']
+        if end_idx > 0:
+            add_personas[(end_idx - 1) % 2] = episode[end_idx - 1]['agg_persona_list']
+        if add_personas[0] == [] and add_personas[1] == []:
+            personas = init_personas
+        else:
+            personas = [list(states[i].update(add_personas[i])) for i in range(2)]
+        yield end_idx, list(window), personas
@@ -0,0 +1,118 @@
+"""Dry-run planning: record the prompts a run would send and estimate its cost.
+
+With --dry_run the API helpers are replaced by the recorders below, so the real pipeline
+renders every prompt but nothing is sent. The report counts input tokens with batched
+tiktoken encoding and estimates output tokens, cost and wall-clock time.
+"""
+import threading
+from collections import defaultdict
+
+# USD per 1M (input, output) tokens; longest matching prefix wins, edit when prices change
+PRICES = {
+    "gpt-3.5-turbo": (0.5, 1.5),
+    "gpt-3.5-turbo-0301": (1.5, 2.0),
+    "gpt-4": (30.0, 60.0),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4o-2024-05-13": (5.0, 15.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-5": (1.25, 10.0),
+}
+# expected length of a generated response in tokens (responses are asked to stay within 30 words)
+RESPONSE_TOKENS = 40
+
+
+class DryRunRecorder:
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def set_chain(self, key):
+        """Calls made under the same chain key (one dialogue) must run one after another."""
+        self.local.chain = key
+
+    def record(self, kind, prompt, output_tokens):
+        with self.lock:
+            self.calls.append((kind, prompt, output_tokens, getattr(self.local, "chain", None)))
+
+    def reset(self):
+        with self.lock:
+            self.calls = []
+
+
+recorder = DryRunRecorder()
+
+
+def dry_summary_results(args, prompt):
+    recorder.record("summary", prompt, args.summary_size)
+    # a memory of about summary_size tokens, so later prompts have a realistic length
+    return " ".join(["memory"] * args.summary_size)
+
+
+def dry_response_results(args, prompt):
+    recorder.record("response", prompt, RESPONSE_TOKENS)
+    return " ".join(["response"] * RESPONSE_TOKENS)
+
+
+def get_price(model_name):
+    matches = [name for name in PRICES if model_name.startswith(name)]
+    if not matches:
+        return None
+    return PRICES[max(matches, key=len)]
+
+
+def count_prompt_tokens(model_name, prompts):
+    import tiktoken
+    try:
+        encoding = tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        encoding = tiktoken.get_encoding("cl100k_base")
+    return [len(tokens) for tokens in encoding.encode_batch(prompts, num_threads=8)]
+
+
+def plan_report(args, calls=None):
+    """Summarise the recorded calls: counts, tokens, cost and wall-clock for args.concurrency."""
+    calls = recorder.calls if calls is None else calls
+    input_tokens = count_prompt_tokens(args.model_name, [prompt for _, prompt, _, _ in calls])
+    by_kind = defaultdict(lambda: {"calls": 0, "input_tokens": 0, "output_tokens": 0})
+    chains = defaultdict(float)
+    total_seconds = 0.0
+    for idx, ((kind, _, output_tokens, chain), n_input) in enumerate(zip(calls, input_tokens)):
+        by_kind[kind]["calls"] += 1
+        by_kind[kind]["input_tokens"] += n_input
+        by_kind[kind]["output_tokens"] += output_tokens
+        seconds = args.call_latency + output_tokens / args.output_tps
+        total_seconds += seconds
+        chains[chain if chain is not None else ("call", idx)] += seconds
+
+    total_input = sum(item["input_tokens"] for item in by_kind.values())
+    total_output = sum(item["output_tokens"] for item in by_kind.values())
+    price = get_price(args.model_name)
+    cost = None if price is None else round((total_input * price[0] + total_output * price[1]) / 1e6, 4)
+    # calls of one dialogue are sequential, so the longest dialogue bounds the wall-clock
+    wall_clock = max(total_seconds / max(args.concurrency, 1), max(chains.values(), default=0.0))
+    return {
+        "model": args.model_name,
+        "calls": len(calls),
+        "by_kind": dict(by_kind),
+        "input_tokens": total_input,
+        "output_tokens": total_output,
+        "max_prompt_tokens": max(input_tokens, default=0),
+        "cost_usd": cost,
+        "concurrency": args.concurrency,
+        "wall_clock_min": round(wall_clock / 60, 2),
+    }
+
+
+def print_plan(args, report):
+    sessions = ",".join(str(session_id) for session_id in args.session_ids)
+    print(f"Dry run for {report['model']} ({args.mode}, session {sessions}):")
+    for kind, item in report["by_kind"].items():
+        print(f"  {kind:<9} calls={item['calls']:<7} input_tokens={item['input_tokens']:<10} output_tokens~{item['output_tokens']}")
+    print(f"  total     calls={report['calls']:<7} input_tokens={report['input_tokens']:<10} output_tokens~{report['output_tokens']}")
+    print(f"  longest prompt: {report['max_prompt_tokens']} tokens")
+    if report["cost_usd"] is None:
+        print(f"  cost: unknown price for {report['model']} (add it to utils/planner.PRICES)")
+    else:
+        print(f"  cost: ~${report['cost_usd']}")
+    print(f"  wall-clock: ~{report['wall_clock_min']} min at concurrency {report['concurrency']}")
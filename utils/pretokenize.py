@@ -0,0 +1,87 @@
+"""Pretokenized (source, target) pairs stored as memory-mapped arrays.
+
+NerCollate.padding_pairs tokenizes the sources and targets of every batch again in every
+epoch. pretokenize() tokenizes them once, the same way (sources without special tokens,
+targets with them), and stores
+
+    ids.npy          int32, the source ids followed by the target ids of every pair, concatenated
+    offsets.npy      int64, pair i is ids[offsets[i]:offsets[i + 1]]
+    source_lens.npy  int32, the number of source ids of every pair (masked out of the labels)
+
+under --data_cache/<name>-<key>/, where the key covers the tokenizer hash, TEMPLATE_VERSION
+and the text of the pairs. Later runs map the arrays and the collator only slices and pads.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# bump when the way sources and targets are built for tokenization changes
+TEMPLATE_VERSION = 1
+
+
+def tokenizer_hash(tokenizer):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(type(tokenizer).__name__.encode("utf-8"))
+    digest.update(json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False).encode("utf-8"))
+    digest.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode("utf-8"))
+    digest.update(json.dumps([getattr(tokenizer, "add_bos_token", None), getattr(tokenizer, "add_eos_token", None)]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def pairs_digest(sources, targets):
+    digest = hashlib.blake2b(digest_size=16)
+    for source, target in zip(sources, targets):
+        digest.update(source.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(target.encode("utf-8"))
+        digest.update(b"\1")
+    return digest.hexdigest()
+
+
+def tokenize_pairs(sources, targets, tokenizer, batch_size=1024):
+    ids, offsets, source_lens = [], [0], []
+    for start in range(0, len(sources), batch_size):
+        tokenized_sources = tokenizer(sources[start:start + batch_size], return_attention_mask=False, add_special_tokens=False)
+        tokenized_targets = tokenizer(targets[start:start + batch_size], return_attention_mask=False, add_special_tokens=True)
+        for s, t in zip(tokenized_sources["input_ids"], tokenized_targets["input_ids"]):
+            ids.extend(s)
+            ids.extend(t)
+            offsets.append(len(ids))
+            source_lens.append(len(s))
+    return {"ids": np.asarray(ids, dtype=np.int32),
+            "offsets": np.asarray(offsets, dtype=np.int64),
+            "source_lens": np.asarray(source_lens, dtype=np.int32)}
+
+
+def load_store(path):
+    return {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in ("ids", "offsets", "source_lens")}
+
+
+def save_store(arrays, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # fill a temporary directory and rename it, so concurrent runs never see a partial store
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(path), suffix=".tmp")
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+    os.chmod(tmp_path, 0o755)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another run saved the same store first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def pretokenize(args, name, sources, targets, tokenizer):
+    """The pretokenized arrays of the pairs, mapped from --data_cache or built and saved there."""
+    if not getattr(args, "data_cache", ""):
+        return tokenize_pairs(sources, targets, tokenizer)
+    key = hashlib.blake2b(json.dumps([tokenizer_hash(tokenizer), TEMPLATE_VERSION, pairs_digest(sources, targets)]).encode("utf-8"),
+                          digest_size=16).hexdigest()
+    path = os.path.join(args.data_cache, f"{name}-{key}")
+    if not os.path.exists(path):
+        save_store(tokenize_pairs(sources, targets, tokenizer), path)
+    return load_store(path)
@@ -0,0 +1,72 @@
+"""Prompt files, loaded once on first use, and their templates compiled for rendering.
+
+    get_template("msc", "gpt-3.5-turbo", "gen_memory1").format_map({"prev_memory": ..., "dialog": ...})
+
+A Template splits its text into literal parts and field names once, so rendering is a join
+instead of re-parsing the format string on every call. Templates with format specs,
+conversions or attribute/index fields fall back to str.format_map.
+"""
+import json
+import string
+from functools import lru_cache
+
+PROMPT_FILES = {
+    "rsum": "prompt.json",
+    "msc": "data/msc/msc/msc_dialogue/prompts.json",
+    "memochat": "memo_chat/prompts.json",
+}
+
+
+@lru_cache(maxsize=None)
+def load_prompts(name):
+    with open(PROMPT_FILES[name], "r") as f:
+        return json.load(f)
+
+
+def get_prompt(name, *keys):
+    """The raw text of a prompt, e.g. get_prompt("rsum", "msc", "gpt-3.5-turbo", "update_memory")."""
+    prompt = load_prompts(name)
+    for key in keys:
+        prompt = prompt[key]
+    return prompt
+
+
+class Template:
+    __slots__ = ("text", "parts", "simple")
+
+    def __init__(self, text):
+        self.text = text
+        self.parts = []
+        self.simple = True
+        for literal, field, spec, conversion in string.Formatter().parse(text):
+            if literal:
+                self.parts.append((literal, None))
+            if field is None:
+                continue
+            if spec or conversion or not field.isidentifier():
+                self.simple = False
+            self.parts.append((None, field))
+
+    def format_map(self, values):
+        if not self.simple:
+            return self.text.format_map(values)
+        out = []
+        for literal, field in self.parts:
+            if field is None:
+                out.append(literal)
+            else:
+                value = values[field]
+                out.append(value if type(value) is str else format(value))
+        return "".join(out)
+
+    def __str__(self):
+        return self.text
+
+
+@lru_cache(maxsize=None)
+def compile_template(text):
+    return Template(text)
+
+
+def get_template(name, *keys):
+    return compile_template(get_prompt(name, *keys))
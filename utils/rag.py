@@ -1,3 +1,4 @@
+import hashlib
 import torch
 import torch.nn.functional as F
 from transformers import(
@@ -17,52 +18,107 @@ q_tokenizer = DPRQuestionEncoderTokenizerFast.from_pretrained(dpr_path)
 d_encoder = DPRQuestionEncoder.from_pretrained(dpr_path).to(device=device)
 d_tokenizer = DPRContextEncoderTokenizerFast.from_pretrained(dpr_path)
 
+# pooled vectors by (type, text hash), shared by every rag() call of the process
+vector_cache = {}
+
+
+def text_key(sentence, type):
+    return type, hashlib.blake2b(sentence.encode("utf-8"), digest_size=16).digest()
+
 
 def embed(sentence, type='q'):
+    return embed_batch([sentence], type=type)
+
+
+def embed_batch(sentences, type='q'):
     if type == 'q':
-        q_input_ids = q_tokenizer(
-            sentence,
+        inputs = q_tokenizer(
+            sentences,
             truncation=True,
             padding="longest",
             return_tensors="pt",
-        )["input_ids"]
-        return q_encoder(q_input_ids.to(device=device), return_dict=True).pooler_output.detach().cpu()
+        )
+        encoder = q_encoder
     else:
-        d_input_ids = d_tokenizer(
-            "",     # title
-            sentence,
+        inputs = d_tokenizer(
+            [""] * len(sentences),     # title
+            sentences,
             truncation=True,
             padding="longest",
             return_tensors="pt"
-        )["input_ids"]
-        return d_encoder(d_input_ids.to(device=device), return_dict=True).pooler_output.detach().cpu()
+        )
+        encoder = d_encoder
+    # only the attention mask is added to what a single unpadded sentence is encoded with
+    with torch.inference_mode():
+        return encoder(inputs["input_ids"].to(device=device), attention_mask=inputs["attention_mask"].to(device=device),
+                       return_dict=True).pooler_output.cpu()
+
 
+def embed_all(sentences, type='q', batch_size=64):
+    """Vectors of the given sentences, encoding each text not in vector_cache once."""
+    keys = [text_key(sentence, type) for sentence in sentences]
+    missing = {}
+    for key, sentence in zip(keys, sentences):
+        if key not in vector_cache:
+            missing[key] = sentence
+    # batches of similar length pad little
+    todo = sorted(missing.items(), key=lambda item: len(item[1]))
+    for start in tqdm(range(0, len(todo), batch_size), desc=f"embed {type}", ncols=100):
+        batch = todo[start:start + batch_size]
+        vectors = embed_batch([sentence for _, sentence in batch], type=type)
+        for (key, _), vector in zip(batch, vectors):
+            vector_cache[key] = vector
+    if not keys:
+        return torch.empty(0)
+    return torch.stack([vector_cache[key] for key in keys])
 
-def rag(data, topk=3):
+
+def dialogue_documents(docs):
+    documents = []
+    tmp_content = ''
+    for doc in docs:
+        if doc['role'] == 'user':
+            tmp_content = doc['content']
+        else:
+            tmp_content += doc['content']
+            documents.append(tmp_content)
+            tmp_content = ''
+    return documents
+
+
+def rag(data, topk=3, batch_size=64, query_chunk=1024):
     s_time = time.time()
-    for i, data_dict in tqdm(enumerate(data)):
+    # the documents of all samples; a dialogue's history is shared by all its turns
+    doc_ids = {}
+    sample_docs, queries = [], []
+    for data_dict in data:
         docs = data_dict['full']
         assert (len(docs)-1) % 2 == 0
-        documents_emb = []
-        documents = []
-        tmp_content = ''
-        for doc in docs[:-1]:
-            if doc['role'] == 'user':
-                tmp_content = doc['content']
-            else:
-                tmp_content += doc['content']
-                documents.append(tmp_content)
-                documents_emb.append(embed(tmp_content, type='d'))
-                tmp_content = ''
-        query = data_dict['window'][-1]['content']
-        query_emb = embed(query, type='q')  # 1,768
-        documents_emb = torch.stack(documents_emb).squeeze()  # N,768
-
-        score = F.cosine_similarity(query_emb, documents_emb, dim=1)
-        index_sorted = torch.topk(score, k=topk, largest=True)[1].tolist()
-
-        data[i]['rag_result_context'] = [documents[idx] for idx in index_sorted]
-        data[i]['rag_result_index'] = index_sorted
+        documents = dialogue_documents(docs[:-1])
+        sample_docs.append((documents, [doc_ids.setdefault(document, len(doc_ids)) for document in documents]))
+        queries.append(data_dict['window'][-1]['content'])
+
+    documents_emb = F.normalize(embed_all(list(doc_ids), type='d', batch_size=batch_size), dim=-1)  # D,768
+    query_emb = F.normalize(embed_all(queries, type='q', batch_size=batch_size), dim=-1)  # N,768
+
+    for start in range(0, len(data), query_chunk):
+        stop = min(start + query_chunk, len(data))
+        max_docs = max(len(ids) for _, ids in sample_docs[start:stop])
+        if max_docs == 0:
+            for i in range(start, stop):
+                data[i]['rag_result_context'], data[i]['rag_result_index'] = [], []
+            continue
+        # cosine similarity of every query of the chunk with every document in one multiply
+        scores = query_emb[start:stop] @ documents_emb.T
+        sample_scores = torch.full((stop - start, max_docs), float("-inf"))
+        for row, (_, ids) in enumerate(sample_docs[start:stop]):
+            sample_scores[row, :len(ids)] = scores[row, ids]
+        top_indices = torch.topk(sample_scores, k=min(topk, max_docs), dim=1, largest=True)[1].tolist()
+        for row, i in enumerate(range(start, stop)):
+            documents, ids = sample_docs[i]
+            index_sorted = top_indices[row][:min(topk, len(ids))]
+            data[i]['rag_result_context'] = [documents[idx] for idx in index_sorted]
+            data[i]['rag_result_index'] = index_sorted
 
     e_time = time.time()
     print("Retrieval finish in " + str(e_time-s_time))
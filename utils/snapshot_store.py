@@ -0,0 +1,200 @@
+"""Versioned memory snapshots with delta encoding.
+
+Successive memories of one dialogue are mostly the same text, so an archive keeps the
+first version of every (model, dialogue) in full and each later session as a word-level
+delta against the previous one. The versions of a dialogue are compressed together as one
+block (zstd if installed, zlib otherwise), and an index at the end of the file maps
+(model, dialogue) to its block, so any (dialogue, session) version is read with one seek.
+
+    python utils/snapshot_store.py pack save_msc --out save_msc/memories.snap
+    python utils/snapshot_store.py get save_msc/memories.snap gpt-3.5-old/summary_dicts sample_5_test.txt-1 4
+
+Archives keep one "model" per source file family, i.e. "<model dir>/<file prefix>".
+"""
+import argparse
+import difflib
+import glob
+import json
+import os
+import pickle
+import re
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b"RSNAP1\n"
+FOOTER = struct.Struct("<QQ")
+re_token = re.compile(r'\S+|\s+')
+re_session_file = re.compile(r'(?:summary_dicts|.*_sum|.*_chain_mem)_sid(\d+)\.(pkl|json)$')
+
+
+def compress(data, codec):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=19).compress(data)
+    return zlib.compress(data, 9)
+
+
+def decompress(data, codec):
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def encode_memory(memory):
+    if isinstance(memory, str):
+        return memory
+    return "\0json\0" + json.dumps(memory, ensure_ascii=False, sort_keys=True)
+
+
+def decode_memory(text):
+    if text.startswith("\0json\0"):
+        return json.loads(text[len("\0json\0"):])
+    return text
+
+
+def make_delta(old, new):
+    """Encode new as [[start, end] copy from old tokens | "inserted text", ...]."""
+    old_tokens, new_tokens = re_token.findall(old), re_token.findall(new)
+    delta = []
+    matcher = difflib.SequenceMatcher(None, old_tokens, new_tokens, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            delta.append([i1, i2])
+        elif j2 > j1:
+            delta.append("".join(new_tokens[j1:j2]))
+    return delta
+
+
+def apply_delta(old, delta):
+    old_tokens = re_token.findall(old)
+    return "".join(piece if isinstance(piece, str) else "".join(old_tokens[piece[0]:piece[1]]) for piece in delta)
+
+
+class SnapshotWriter:
+    def __init__(self, path, codec=None):
+        self.path = path
+        self.codec = codec or ("zstd" if zstandard is not None else "zlib")
+        self.chains = {}
+
+    def add(self, model, dial_id, session_id, memory):
+        self.chains.setdefault((model, dial_id), {})[session_id] = encode_memory(memory)
+
+    def close(self):
+        index = {}
+        with open(self.path, "wb") as f:
+            f.write(MAGIC + self.codec.encode("ascii") + b"\n")
+            for (model, dial_id), versions in self.chains.items():
+                sessions = sorted(versions)
+                records, prev = [], None
+                for session_id in sessions:
+                    text = versions[session_id]
+                    records.append(text if prev is None else make_delta(prev, text))
+                    prev = text
+                block = compress(json.dumps(records, ensure_ascii=False).encode("utf-8"), self.codec)
+                index[f"{model}\t{dial_id}"] = [f.tell(), len(block), sessions]
+                f.write(block)
+            index_offset = f.tell()
+            index_block = compress(json.dumps(index).encode("utf-8"), self.codec)
+            f.write(index_block)
+            f.write(FOOTER.pack(index_offset, len(index_block)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SnapshotArchive:
+    """Random access to the memories of a snapshot archive."""
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a memory snapshot archive")
+        self.codec = self.file.readline().decode("ascii").strip()
+        if self.codec == "zstd" and zstandard is None:
+            raise ImportError(f"{path} is zstd compressed, please pip install zstandard")
+        self.file.seek(-FOOTER.size, os.SEEK_END)
+        index_offset, index_length = FOOTER.unpack(self.file.read(FOOTER.size))
+        self.file.seek(index_offset)
+        self.entries = json.loads(decompress(self.file.read(index_length), self.codec))
+
+    def keys(self):
+        return [tuple(key.split("\t", 1)) for key in self.entries]
+
+    def sessions(self, model, dial_id):
+        return self.entries[f"{model}\t{dial_id}"][2]
+
+    def versions(self, model, dial_id):
+        """Return {session_id: memory} for every stored version of a dialogue."""
+        offset, length, sessions = self.entries[f"{model}\t{dial_id}"]
+        self.file.seek(offset)
+        records = json.loads(decompress(self.file.read(length), self.codec))
+        result, prev = {}, None
+        for session_id, record in zip(sessions, records):
+            prev = record if prev is None else apply_delta(prev, record)
+            result[session_id] = decode_memory(prev)
+        return result
+
+    def get(self, model, dial_id, session_id, default=None):
+        key = f"{model}\t{dial_id}"
+        if key not in self.entries or session_id not in self.entries[key][2]:
+            return default
+        return self.versions(model, dial_id)[session_id]
+
+    def session(self, model, session_id):
+        """Return {dial_id: memory} of one session, the format of load_prev_summary."""
+        return {dial_id: self.get(m, dial_id, session_id) for m, dial_id in self.keys()
+                if m == model and session_id in self.sessions(m, dial_id)}
+
+    def close(self):
+        self.file.close()
+
+
+def load_memory_file(path):
+    if path.endswith(".pkl"):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def pack(saving_dir, out):
+    """Pack every summary_dicts_sid*.pkl / *_sum_sid*.json / *_chain_mem_sid*.json under saving_dir/<model>/."""
+    raw_bytes = 0
+    with SnapshotWriter(out) as writer:
+        for path in sorted(glob.glob(os.path.join(saving_dir, "*", "*"))):
+            match = re_session_file.match(os.path.basename(path))
+            if match is None:
+                continue
+            model = os.path.basename(os.path.dirname(path))
+            name = re.sub(r'_sid\d+\.(pkl|json)$', '', os.path.basename(path))
+            raw_bytes += os.path.getsize(path)
+            for dial_id, memory in load_memory_file(path).items():
+                writer.add(f"{model}/{name}", dial_id, int(match.group(1)), memory)
+    print(f"packed {raw_bytes} bytes into {os.path.getsize(out)} bytes ({out})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    pack_parser = subparsers.add_parser("pack")
+    pack_parser.add_argument("saving_dir")
+    pack_parser.add_argument("--out", required=True)
+    get_parser = subparsers.add_parser("get")
+    get_parser.add_argument("archive")
+    get_parser.add_argument("model")
+    get_parser.add_argument("dial_id")
+    get_parser.add_argument("session_id", type=int)
+    cli_args = parser.parse_args()
+    if cli_args.command == "pack":
+        pack(cli_args.saving_dir, cli_args.out)
+    else:
+        archive = SnapshotArchive(cli_args.archive)
+        print(archive.get(cli_args.model, cli_args.dial_id, cli_args.session_id))
+        archive.close()
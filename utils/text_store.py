@@ -0,0 +1,77 @@
+"""Dataset fields packed into flat byte buffers that DataLoader workers share.
+
+A list of records is millions of small Python objects; with num_workers > 0 every read
+touches their reference counts, so each worker gradually copies the pages of the whole corpus.
+build_store() writes every field as one UTF-8 byte array plus an int64 offset array (fields
+that are not strings are stored as JSON), to a directory in /dev/shm when it exists. Stores
+are memory-mapped, pickle as their path only, and decode a value on access, so workers map
+the same pages instead of copying them.
+"""
+import json
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+
+
+def write_field(path, field, values):
+    as_json = not all(isinstance(value, str) for value in values)
+    encoded = [(json.dumps(value, ensure_ascii=False) if as_json else value).encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    np.save(os.path.join(path, f"{field}.offsets.npy"), offsets)
+    np.save(os.path.join(path, f"{field}.bytes.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+    return as_json
+
+
+class TextStore:
+    def __init__(self, path):
+        self.path = path
+        self.open()
+
+    def open(self):
+        with open(os.path.join(self.path, "fields.json"), "r") as f:
+            self.as_json = json.load(f)
+        self.fields = list(self.as_json)
+        self.buffers = {field: np.load(os.path.join(self.path, f"{field}.bytes.npy"), mmap_mode="r") for field in self.fields}
+        self.offsets = {field: np.load(os.path.join(self.path, f"{field}.offsets.npy"), mmap_mode="r") for field in self.fields}
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self.open()
+
+    def get(self, index, field):
+        offsets = self.offsets[field]
+        value = self.buffers[field][offsets[index]:offsets[index + 1]].tobytes().decode("utf-8")
+        return json.loads(value) if self.as_json[field] else value
+
+    def record(self, index):
+        return {field: self.get(index, field) for field in self.fields}
+
+    def __len__(self):
+        return len(self.offsets[self.fields[0]]) - 1
+
+
+def remove_store(path, owner_pid):
+    # forked DataLoader workers inherit the store object, and with it this finalizer
+    if os.getpid() == owner_pid:
+        shutil.rmtree(path, True)
+
+
+def build_store(records, fields, root=None):
+    """Pack records[i][field] into a new TextStore, removed again when the store is collected."""
+    if root is None:
+        root = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    path = tempfile.mkdtemp(prefix="text_store-", dir=root)
+    as_json = {field: write_field(path, field, [record[field] for record in records]) for field in fields}
+    with open(os.path.join(path, "fields.json"), "w") as f:
+        json.dump(as_json, f)
+    store = TextStore(path)
+    # only the building process removes the files, whether workers get the store forked or pickled
+    weakref.finalize(store, remove_store, path, os.getpid())
+    return store
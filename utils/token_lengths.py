@@ -0,0 +1,114 @@
+"""Token counts of the context fields of every sample, stored next to the corpus cache.
+
+    lengths = length_index(args, read_msc_test_data, "test")             # tiktoken cl100k_base
+    lengths = length_index(args, read_msc_test_data, "test", tokenizer)  # a HF tokenizer
+    full_lengths = lengths[:, FIELDS.index("full")]
+
+The index is an int32 array with one row per sample of the cached corpus and one column per
+field in FIELDS. It is saved as <corpus cache file>.len-<tokenizer>.npy and memory-mapped by
+later runs, so batching, budgeting and statistics read lengths instead of re-tokenizing.
+Texts repeated across the turns of a dialogue (history, memory) are tokenized once. "memory" is
+the gold previous summary and "pred_memory" the predicted one that the rsum prompts use.
+"""
+import os
+import re
+import tempfile
+from functools import lru_cache
+
+import numpy as np
+
+FIELDS = ("full", "window", "history", "memory", "pred_memory", "label")
+
+
+def as_text(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, dict):
+        # chat messages
+        return as_text(value.get("content", ""))
+    if isinstance(value, (list, tuple)):
+        return " ".join(as_text(item) for item in value)
+    return "" if value is None else str(value)
+
+
+def sample_text(sample, field):
+    if field == "memory":
+        value = sample.get("gt_prev_summary_string", "")
+    elif field == "pred_memory":
+        value = sample.get("pred_prev_summary", "")
+    elif field == "label":
+        value = sample.get("response", sample.get("label", ""))
+    else:
+        value = sample.get(field, "")
+    return as_text(value)
+
+
+@lru_cache(maxsize=1)
+def get_encoding():
+    import tiktoken
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def tokenizer_key(tokenizer=None):
+    """File-name key of a tokenizer: "tiktoken" for cl100k_base, else the HF name_or_path."""
+    if tokenizer is None:
+        return "tiktoken"
+    name = getattr(tokenizer, "name_or_path", "") or type(tokenizer).__name__
+    return "hf-" + re.sub(r"[^A-Za-z0-9_.-]+", "_", name.strip("/"))
+
+
+def count_tokens(texts, tokenizer=None):
+    if not texts:
+        return []
+    if tokenizer is None:
+        return [len(tokens) for tokens in get_encoding().encode_ordinary_batch(texts)]
+    return [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+
+def build_lengths(samples, tokenizer=None, batch_size=1024):
+    lengths = np.zeros((len(samples), len(FIELDS)), dtype=np.int32)
+    text_ids = {}
+    cells = []
+    for row, sample in enumerate(samples):
+        for col, field in enumerate(FIELDS):
+            text = sample_text(sample, field)
+            cells.append(text_ids.setdefault(text, len(text_ids)))
+    texts = list(text_ids)
+    counts = []
+    for start in range(0, len(texts), batch_size):
+        counts.extend(count_tokens(texts[start:start + batch_size], tokenizer))
+    if cells:
+        lengths[:] = np.asarray(counts, dtype=np.int32)[np.asarray(cells)].reshape(lengths.shape)
+    return lengths
+
+
+def sidecar_path(cache_file, tokenizer=None):
+    return f"{os.path.splitext(cache_file)[0]}.len-{tokenizer_key(tokenizer)}.npy"
+
+
+def save_lengths(lengths, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        np.save(f, lengths)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+def length_index(args, loader, *params, tokenizer=None, samples=None):
+    """Token lengths of loader(args, *params), read from its sidecar or built and saved there."""
+    cache_file = getattr(loader, "cache_file", None)
+    path = cache_file(args, *params) if cache_file is not None else None
+    if path is not None:
+        path = sidecar_path(path, tokenizer)
+        if os.path.exists(path):
+            lengths = np.load(path, mmap_mode="r")
+            # indexes saved with other FIELDS are rebuilt
+            if lengths.ndim == 2 and lengths.shape[1] == len(FIELDS) and (samples is None or len(lengths) == len(samples)):
+                return lengths
+    if samples is None:
+        samples = loader(args, *params)
+    lengths = build_lengths(samples, tokenizer)
+    if path is not None:
+        save_lengths(lengths, path)
+    return lengths
@@ -0,0 +1,144 @@
+"""Turn records that point into a shared per-dialogue utterance array.
+
+Every test sample used to carry its own copies of the dialogue so far (prev_content,
+win_content, all_content and the joined full/window strings), so a dialogue of T turns took
+O(T^2) memory to load. A Dialogue keeps the utterances once; a turn record keeps only the
+offset of its turn, and the context fields are built when they are read. Records behave like
+the old dicts: record["window"], record.get(...), and keys set later (e.g. "input", "label")
+are stored on the record.
+"""
+from collections.abc import MutableMapping
+
+
+class Dialogue:
+    __slots__ = ("utterances", "starts", "sessions")
+
+    def __init__(self):
+        self.utterances = []
+        # utterance offset where each session starts
+        self.starts = []
+        # the joined text of every finished session
+        self.sessions = []
+
+    def start_session(self):
+        self.starts.append(len(self.utterances))
+
+    def end_session(self):
+        self.sessions.append(" ".join(self.utterances[self.starts[-1]:]))
+
+    def add(self, utterance):
+        self.utterances.append(utterance)
+
+
+class TurnRecord(MutableMapping):
+    __slots__ = ("dialogue", "session", "end", "extra")
+    # keys stored in slots of the subclass, and keys computed from the dialogue
+    fields = ()
+    views = ()
+
+    def __init__(self, dialogue, **values):
+        self.dialogue = dialogue
+        self.session = len(dialogue.starts) - 1
+        self.end = len(dialogue.utterances)
+        self.extra = None
+        for key in self.fields:
+            setattr(self, key, values[key])
+
+    # context views
+    @property
+    def history(self):
+        return self.dialogue.sessions[:self.session]
+
+    @property
+    def prev_content(self):
+        return self.dialogue.utterances[:self.dialogue.starts[self.session]]
+
+    @property
+    def win_content(self):
+        return self.dialogue.utterances[self.dialogue.starts[self.session]:self.end]
+
+    @property
+    def all_content(self):
+        return self.dialogue.utterances[:self.end]
+
+    @property
+    def window(self):
+        return " ".join(self.win_content)
+
+    def __getitem__(self, key):
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        if key in self.fields or key in self.views:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.fields:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if self.extra is None or key not in self.extra:
+            raise KeyError(key)
+        del self.extra[key]
+
+    def __iter__(self):
+        yield from self.fields
+        yield from self.views
+        if self.extra is not None:
+            yield from (key for key in self.extra if key not in self.fields and key not in self.views)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def copy(self):
+        return dict(self)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self['dial_id']!r})"
+
+
+class MSCTurn(TurnRecord):
+    __slots__ = ("response", "pred_prev_summary", "gt_prev_summary", "gt_prev_summary_string", "dial_id")
+    fields = __slots__
+    views = ("full", "prev_content", "win_content", "all_content", "history", "window")
+
+    @property
+    def full(self):
+        return " ".join(self.history + self.win_content)
+
+
+class CareTurn(TurnRecord):
+    __slots__ = ("dial_id", "first_turn", "response", "last_turn", "gt_prev_summary_string", "summary")
+    fields = __slots__
+    views = ("prev_list", "history", "full", "all_content", "window")
+
+    @property
+    def prev_list(self):
+        return self.history
+
+    @property
+    def full(self):
+        return " ".join(self.history) + " " + self.window
+
+
+class ChatTurn(TurnRecord):
+    """Turn of a dialogue whose utterances are (role, content) pairs, read as chat messages."""
+    __slots__ = ("dial_id", "label")
+    fields = __slots__
+    views = ("full", "window")
+
+    def messages(self, start=0):
+        """Return fresh {"role", "content"} dicts of the utterances [start, end) of the dialogue."""
+        return [{"role": role, "content": content} for role, content in self.dialogue.utterances[start:self.end]]
+
+    @property
+    def full(self):
+        return self.messages()
+
+    @property
+    def window(self):
+        return self.messages(self.dialogue.starts[self.session])